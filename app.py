@@ -1,12 +1,30 @@
 import os
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from datetime import datetime, date, time, timedelta
+import base64
+import hashlib
 import json
+import mimetypes
+import random
+import secrets
+import sqlite3
+import tempfile
+import threading
+from time import sleep, monotonic, perf_counter, time as wall_clock
+from dataclasses import dataclass, asdict
 from dateutil.rrule import rrule, DAILY
 import pytz
+import click
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, send_file, abort, make_response
-from flask_session import Session
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, JSON as SAJSON, select, and_, or_
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, send_file, abort, make_response, Response, stream_with_context, g
+from flask.sessions import SecureCookieSession, SessionInterface
+from werkzeug.security import safe_join
+from sqlalchemy import event, create_engine, inspect, text, Column, Integer, String, DateTime, Text, JSON as SAJSON, Index, UniqueConstraint, select, insert, update, delete, and_, or_, func, exists, case, tuple_, literal, union_all
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session as SASession
 
 import requests
@@ -14,15 +32,16 @@ from flask import request
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
+# Overridable so the outbox can be pointed at a local stub server
+TELEGRAM_API = os.environ.get("TELEGRAM_API", "https://api.telegram.org").rstrip("/")
 
-def send_telegram(text: str):
+def send_telegram(text: str, http=None):
+    """POST one message. Raises on failure so the outbox can retry it."""
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
         return
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        requests.post(url, json={"chat_id": TELEGRAM_CHAT_ID, "text": text}, timeout=5)
-    except Exception:
-        pass  # don’t crash booking if Telegram is being moody
+    url = f"{TELEGRAM_API}/bot{TELEGRAM_TOKEN}/sendMessage"
+    resp = (http or requests).post(url, json={"chat_id": TELEGRAM_CHAT_ID, "text": text}, timeout=5)
+    resp.raise_for_status()
 
 
 # ------------ Config ------------
@@ -41,6 +60,9 @@ BUSINESS_HOURS = {
     6: (None, None)  # Sunday closed
 }
 
+# One-off closures on top of BUSINESS_HOURS, e.g. SHOP_CLOSED_DATES="2025-12-25,2026-01-01"
+CLOSED_DATES = {date.fromisoformat(d.strip()) for d in os.environ.get("SHOP_CLOSED_DATES", "").split(",") if d.strip()}
+
 # Capacity per resource type (parallel bays / teams)
 RESOURCE_CAPACITY = {
     "wash": 2,
@@ -67,11 +89,218 @@ ADMIN_PASSWORD = os.environ.get("ADMIN_PASS", "admin")
 # ------------ App / DB setup ------------
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "change-this")
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
 
 DB_URL = os.environ.get("DATABASE_URL", "sqlite:///booking.db")
-engine = create_engine(DB_URL, future=True, echo=False)
+
+# ------------ Database profile ------------
+# "tuned" applies the settings below; "default" keeps SQLAlchemy/driver defaults (for benchmarking)
+DB_PROFILE = os.environ.get("DB_PROFILE", "tuned")
+# SQLite: WAL lets availability reads carry on while a booking commits
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),  # durable with WAL except on power loss
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": "MEMORY",
+}
+# Postgres: per worker process, so size against max_connections / gunicorn workers
+PG_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+PG_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+PG_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+PG_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# psycopg 3 prepares a statement server-side after it has run this many times on a connection
+PG_PREPARE_THRESHOLD = int(os.environ.get("DB_PREPARE_THRESHOLD", "2"))
+
+def engine_options(url) -> dict:
+    opts = {"future": True, "echo": False}
+    if DB_PROFILE != "tuned":
+        return opts
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        opts["connect_args"] = {"timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000}
+    elif backend == "postgresql":
+        opts.update(pool_size=PG_POOL_SIZE, max_overflow=PG_MAX_OVERFLOW, pool_recycle=PG_POOL_RECYCLE,
+                    pool_timeout=PG_POOL_TIMEOUT, pool_pre_ping=True, pool_use_lifo=True)
+        if url.get_driver_name() == "psycopg":
+            opts["connect_args"] = {"prepare_threshold": PG_PREPARE_THRESHOLD}
+    return opts
+
+def apply_sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    cur.close()
+
+engine = create_engine(DB_URL, **engine_options(make_url(DB_URL)))
+if DB_PROFILE == "tuned" and engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+# gunicorn --preload imports once and forks: children must not reuse the parent's pooled connections
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+# ------------ Instrumentation ------------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Optional bearer token guarding /metrics
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+class Metrics:
+    """Process-local counters and histograms, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # name -> (type, help)
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+
+    def describe(self, name: str, kind: str, text: str):
+        self._meta[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            i = bisect_left(LATENCY_BUCKETS, value)
+            if i < len(LATENCY_BUCKETS):
+                h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def render(self, extra=()) -> str:
+        """Prometheus exposition; `extra` adds (name, type, help, value) samples read at scrape time."""
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+        out, seen = [], set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# HELP {name} {self._meta.get(name, (kind, name))[1]}")
+                out.append(f"# TYPE {name} {kind}")
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                header(name, "counter")
+                out.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                header(name, "histogram")
+                cumulative = 0
+                for le, n in zip(LATENCY_BUCKETS, h):
+                    cumulative += n
+                    out.append(f"{name}_bucket{fmt(labels + (('le', le),))} {cumulative}")
+                out.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {h[-1]}")
+                out.append(f"{name}_sum{fmt(labels)} {h[-2]}")
+                out.append(f"{name}_count{fmt(labels)} {h[-1]}")
+        for name, kind, help_text, value in extra:
+            self.describe(name, kind, help_text)
+            header(name, kind)
+            out.append(f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe("carshop_http_request_seconds", "histogram", "Request latency by route.")
+metrics.describe("carshop_http_request_queries_total", "counter", "SQL statements issued while serving requests, by route.")
+metrics.describe("carshop_http_request_db_seconds_total", "counter", "Time spent in SQL while serving requests, by route.")
+metrics.describe("carshop_db_query_seconds", "histogram", "Latency of individual SQL statements.")
+metrics.describe("carshop_section_seconds", "histogram", "Time spent in instrumented functions.")
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "sections")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.sections = {}
+
+_stats = threading.local()
+
+def current_stats() -> RequestStats:
+    st = getattr(_stats, "current", None)
+    if st is None:
+        st = _stats.current = RequestStats()
+    return st
+
+@event.listens_for(engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info["query_started"].pop()
+    st = current_stats()
+    st.queries += 1
+    st.db_seconds += elapsed
+    metrics.observe("carshop_db_query_seconds", elapsed)
+
+def timed(section: str):
+    """Record the wrapped function's time in the current request's Server-Timing and in /metrics."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - started
+                st = current_stats()
+                st.sections[section] = st.sections.get(section, 0.0) + elapsed
+                metrics.observe("carshop_section_seconds", elapsed, section=section)
+        return wrapper
+    return decorator
+
+@contextmanager
+def query_budget(max_queries: int):
+    """Fail (for tests) when the block issues more than max_queries SQL statements on this thread."""
+    st = current_stats()
+    before = st.queries
+    yield
+    used = st.queries - before
+    if used > max_queries:
+        raise QueryBudgetExceeded(f"{used} queries issued, budget was {max_queries}")
+
+# When set (e.g. in tests), every request must stay within this many queries
+app.config["QUERY_BUDGET"] = int(os.environ["QUERY_BUDGET"]) if os.environ.get("QUERY_BUDGET") else None
+
+@app.before_request
+def start_request_stats():
+    _stats.current = RequestStats()
+    g.request_started = perf_counter()
+
+def record_request_stats(route: str, method: str, path: str, elapsed: float, st: RequestStats):
+    metrics.observe("carshop_http_request_seconds", elapsed, route=route, method=method)
+    metrics.inc("carshop_http_request_queries_total", st.queries, route=route)
+    metrics.inc("carshop_http_request_db_seconds_total", st.db_seconds, route=route)
+    budget = app.config.get("QUERY_BUDGET")
+    if budget is not None and st.queries > budget:
+        raise QueryBudgetExceeded(f"{method} {path} issued {st.queries} queries, budget is {budget}")
+
+@app.after_request
+def finish_request_stats(resp):
+    started = g.get("request_started", perf_counter())
+    elapsed = perf_counter() - started
+    st = current_stats()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    timings = [f'app;dur={elapsed * 1000:.1f}', f'db;dur={st.db_seconds * 1000:.1f};desc="{st.queries} queries"']
+    timings += [f"{name};dur={sec * 1000:.1f}" for name, sec in st.sections.items()]
+    if resp.is_streamed:
+        # A streamed body (the calendar feed) runs its queries after this hook, on this thread:
+        # the header can only cover what ran before it, so metrics and the query budget are
+        # settled once the body has been sent
+        timings.append('body;desc="streamed, not in these totals"')
+        method, path = request.method, request.path
+        resp.call_on_close(lambda: record_request_stats(route, method, path, perf_counter() - started, st))
+    else:
+        record_request_stats(route, request.method, request.path, elapsed, st)
+    resp.headers["Server-Timing"] = ", ".join(timings)
+    return resp
 
 class Base(DeclarativeBase):
     pass
@@ -88,8 +317,8 @@ class Service(Base):
     is_addon: Mapped[int] = mapped_column(Integer, default=0)  # 0/1
     description: Mapped[str] = mapped_column(Text, default="")
 
-class Appointment(Base):
-    __tablename__ = "appointments"
+class AppointmentColumns:
+    # Shared by the live table and the archive, so a row moves between them column for column
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     customer_name: Mapped[str] = mapped_column(String(120))
     phone: Mapped[str] = mapped_column(String(40))
@@ -102,33 +331,467 @@ class Appointment(Base):
     total_price: Mapped[int] = mapped_column(Integer, default=0)
     status: Mapped[str] = mapped_column(String(40), default="booked")  # booked, in_progress, done, canceled
     notes: Mapped[str] = mapped_column(Text, default="")
+    # Id of the latest appointment_changes row for this appointment; delta feeds page on it
+    seq: Mapped[int] = mapped_column(Integer, nullable=True, index=True)
+    # iCal SEQUENCE: 0 when booked, +1 for every later change
+    revision: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+class Appointment(AppointmentColumns, Base):
+    __tablename__ = "appointments"
+    __table_args__ = (
+        # admin day lists, /api/events and feed windows filter on start time
+        Index("ix_appointments_start", "start_utc", "end_utc"),
+        # keyset pagination walks (start_utc, id)
+        Index("ix_appointments_keyset", "start_utc", "id"),
+    )
+
+class ArchivedAppointment(AppointmentColumns, Base):
+    # Finished appointments past ARCHIVE_AFTER_DAYS, moved here by archive_appointments()
+    __tablename__ = "appointments_archive"
+    __table_args__ = (
+        Index("ix_appointments_archive_keyset", "start_utc", "id"),
+        # max(end_utc) tells window queries whether the archive can hold anything for them
+        Index("ix_appointments_archive_end", "end_utc"),
+    )
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)  # keeps the live id
+    archived_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
+
+class AppointmentSegment(Base):
+    # Where and when each part of an appointment (primary service, each add-on) runs
+    __tablename__ = "appointment_segments"
+    # load_occupancy's range scan; appointment_id makes it covering up to the join
+    __table_args__ = (Index("ix_segments_window", "resource_type", "start_utc", "end_utc", "appointment_id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    appointment_id: Mapped[int] = mapped_column(Integer, index=True)
+    resource_type: Mapped[str] = mapped_column(String(40))
+    start_utc: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    end_utc: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+class Reservation(Base):
+    # One row per (resource, time bucket, bay) an appointment holds; the unique
+    # constraint is what makes two concurrent bookings unable to share a bay.
+    __tablename__ = "reservations"
+    __table_args__ = (UniqueConstraint("resource_type", "bucket", "unit", name="uq_reservation_unit"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    appointment_id: Mapped[int] = mapped_column(Integer, index=True)
+    resource_type: Mapped[str] = mapped_column(String(40))
+    bucket: Mapped[datetime] = mapped_column(DateTime(timezone=True))  # UTC bucket start
+    unit: Mapped[int] = mapped_column(Integer)  # 0 .. capacity-1
+
+class OutboxMessage(Base):
+    # Notifications written with the booking, delivered later by OutboxDispatcher
+    __tablename__ = "outbox"
+    __table_args__ = (Index("ix_outbox_due", "status", "next_attempt_at"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    channel: Mapped[str] = mapped_column(String(40))  # telegram
+    payload: Mapped[str] = mapped_column(Text)  # JSON
+    status: Mapped[str] = mapped_column(String(20), default="pending")  # pending, sending, sent, failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    last_error: Mapped[str] = mapped_column(Text, default="")
+
+class AppointmentChange(Base):
+    # Append-only log of appointment writes; its newest row versions the calendar feed
+    __tablename__ = "appointment_changes"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    appointment_id: Mapped[int] = mapped_column(Integer, index=True)
+    changed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
+
+class WebSession(Base):
+    # Server-side sessions, used only with SESSION_BACKEND=sql
+    __tablename__ = "web_sessions"
+    id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    data: Mapped[str] = mapped_column(Text, default="{}")
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), index=True)
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(120))
+    applied_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(pytz.utc))
+
+# ------------ Schema migrations ------------
+# Applied by `flask init-db` (see init_db below), never on import: workers only read the version.
+def _baseline(conn):
+    # Databases from before migrations already have some of these; create_all skips existing tables
+    Base.metadata.create_all(conn)
+
+def _appointment_indexes(conn):
+    # create_all does not add indexes to tables that already existed; columns a later migration adds are skipped
+    existing = {c["name"] for c in inspect(conn).get_columns("appointments")}
+    for ix in Appointment.__table__.indexes:
+        if {c.name for c in ix.columns} <= existing:
+            ix.create(conn, checkfirst=True)
+
+def _appointment_sequence(conn):
+    # Rows get their values from backfill_sequences() in init_db
+    existing = {c["name"] for c in inspect(conn).get_columns("appointments")}
+    if "seq" not in existing:
+        conn.execute(text("ALTER TABLE appointments ADD COLUMN seq INTEGER"))
+    if "revision" not in existing:
+        conn.execute(text("ALTER TABLE appointments ADD COLUMN revision INTEGER NOT NULL DEFAULT 0"))
+    _appointment_indexes(conn)
+
+def _web_sessions(conn):
+    WebSession.__table__.create(conn, checkfirst=True)
+
+def _appointment_archive(conn):
+    ArchivedAppointment.__table__.create(conn, checkfirst=True)
+
+def _occupancy_indexes(conn):
+    # Capacity reads appointment_segments now; the appointments-side window index only cost writes
+    conn.execute(text("DROP INDEX IF EXISTS ix_appointments_resource_window"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_segments_window"))
+    next(ix for ix in AppointmentSegment.__table__.indexes if ix.name == "ix_segments_window").create(conn)
+
+MIGRATIONS = [
+    (1, "baseline tables", _baseline),
+    (2, "appointment window indexes", _appointment_indexes),
+    (3, "web sessions", _web_sessions),
+    (4, "appointment keyset index", _appointment_indexes),
+    (5, "appointment search index", lambda conn: search_index.create(conn)),
+    (6, "appointment seq and revision", _appointment_sequence),
+    (7, "appointment archive", _appointment_archive),
+    (8, "covering segment window index", _occupancy_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+MIGRATION_LOCK_KEY = 72616375  # Postgres advisory lock id shared by every init-db run
+
+def schema_version(conn) -> int:
+    if not inspect(conn).has_table(SchemaMigration.__tablename__):
+        return 0
+    return conn.scalar(select(func.max(SchemaMigration.version))) or 0
+
+@contextmanager
+def migration_lock():
+    """Only one init-db at a time: an advisory lock on Postgres, a lock file next to a SQLite database."""
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        return
+    path = engine.url.database if engine.dialect.name == "sqlite" else None
+    if not path or path == ":memory:":
+        yield
+        return
+    # A separate file, not BEGIN EXCLUSIVE: each migration step commits on its own connection
+    with open(path + ".lock", "w") as f:
+        _lock_file(f)
+        try:
+            yield
+        finally:
+            _unlock_file(f)
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_file(f):
+        # LK_LOCK gives up after ~10 s; another init-db may take longer, so keep waiting
+        while True:
+            try:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+    def _unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock_file(f):
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+    def _unlock_file(f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def migrate() -> list[int]:
+    """Apply pending migrations, each in its own transaction; returns the versions applied.
+
+    Callers hold migration_lock().
+    """
+    with engine.begin() as conn:
+        SchemaMigration.__table__.create(conn, checkfirst=True)
+        current = schema_version(conn)
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.now(pytz.utc)))
+        applied.append(version)
+    return applied
+
+# ------------ Sessions ------------
+# Only the admin flag lives in the session. "cookie" keeps it in Flask's signed cookie (no server
+# I/O at all); "sql" keeps it in web_sessions and the cookie carries just a random id.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "cookie")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(7 * 24 * 3600)))
+# Seconds between purges of expired web_sessions rows, per worker
+SESSION_COMPACT_INTERVAL = int(os.environ.get("SESSION_COMPACT_INTERVAL", "600"))
+app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(seconds=SESSION_TTL)
+app.config["SESSION_COOKIE_HTTPONLY"] = True
+app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+app.config["SESSION_COOKIE_SECURE"] = os.environ.get("SESSION_COOKIE_SECURE") == "1"
+
+class SqlSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+
+class SqlSessionInterface(SessionInterface):
+    """Sessions in web_sessions. Rows past expires_at are ignored on read and purged periodically.
+
+    Visitors who never log in get neither a row nor a cookie.
+    """
+
+    def __init__(self, ttl: int, compact_interval: int):
+        self.ttl, self.compact_interval = ttl, compact_interval
+        self._next_compact = 0.0
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with engine.connect() as conn:
+                data = conn.scalar(select(WebSession.data).where(
+                    WebSession.id == sid, WebSession.expires_at > datetime.now(pytz.utc)))
+            if data is not None:
+                return SqlSession(json.loads(data), sid)
+        return SqlSession()
+
+    def save_session(self, app, sess, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not sess:
+            if sess.sid is not None and sess.modified:
+                with engine.begin() as conn:
+                    conn.execute(delete(WebSession).where(WebSession.id == sess.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, sess):
+            return
+        if sess.sid is None:
+            sess.sid = secrets.token_urlsafe(32)
+        row = {"data": json.dumps(dict(sess)), "expires_at": datetime.now(pytz.utc) + timedelta(seconds=self.ttl)}
+        with engine.begin() as conn:
+            if not conn.execute(update(WebSession).where(WebSession.id == sess.sid).values(**row)).rowcount:
+                conn.execute(insert(WebSession).values(id=sess.sid, **row))
+        response.set_cookie(name, sess.sid, expires=self.get_expiration_time(app, sess),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+        self.compact()
+
+    def compact(self, force: bool = False) -> int:
+        now = monotonic()
+        with self._lock:
+            if not force and now < self._next_compact:
+                return 0
+            self._next_compact = now + self.compact_interval
+        with engine.begin() as conn:
+            return conn.execute(delete(WebSession).where(WebSession.expires_at <= datetime.now(pytz.utc))).rowcount
+
+if SESSION_BACKEND == "sql":
+    app.session_interface = SqlSessionInterface(SESSION_TTL, SESSION_COMPACT_INTERVAL)
+elif SESSION_BACKEND != "cookie":
+    raise ValueError(f"SESSION_BACKEND must be 'cookie' or 'sql', not {SESSION_BACKEND!r}")
+
+# ------------ Service catalog cache ------------
+@dataclass(frozen=True, slots=True)
+class ServiceRecord:
+    id: int
+    name: str
+    code: str
+    price: int
+    resource_type: str
+    duration_minutes: int
+    duration_days: int
+    is_addon: bool
+    description: str
+
+class Catalog:
+    """Immutable snapshot of the services table, built once per catalog version."""
+    __slots__ = ("version", "by_code", "all", "services", "addons", "all_data", "all_json", "fingerprint")
 
-Base.metadata.create_all(engine)
+    def __init__(self, version: int, records: list[ServiceRecord]):
+        self.version = version
+        self.all = tuple(sorted(records, key=lambda r: r.id))
+        self.by_code = {r.code: r for r in self.all}
+        self.services = tuple(sorted((r for r in self.all if not r.is_addon), key=lambda r: r.name))
+        self.addons = tuple(sorted((r for r in self.all if r.is_addon), key=lambda r: r.name))
+        # JSON-ready copies, serialized once per version rather than per request
+        self.all_data = [asdict(r) for r in self.all]
+        self.all_json = json.dumps(self.all_data, sort_keys=True).encode()
+        # Same in every worker for the same table contents, unlike `version`
+        self.fingerprint = hashlib.sha1(self.all_json).hexdigest()[:12]
+
+    def get(self, code: str):
+        return self.by_code.get(code)
+
+    def lookup(self, codes) -> list[ServiceRecord]:
+        """Records for the known codes, in the order given; unknown codes are dropped."""
+        return [self.by_code[c] for c in codes if c in self.by_code]
+
+_catalog = None
+_catalog_version = 0
+_catalog_lock = threading.Lock()
+
+def invalidate_catalog():
+    """Call after anything writes to the services table."""
+    global _catalog_version
+    with _catalog_lock:
+        _catalog_version += 1
+
+def get_catalog() -> Catalog:
+    global _catalog
+    cat = _catalog
+    if cat is not None and cat.version == _catalog_version:
+        return cat
+    with _catalog_lock:
+        if _catalog is None or _catalog.version != _catalog_version:
+            with SASession(engine) as s:
+                records = [ServiceRecord(
+                    id=sv.id, name=sv.name, code=sv.code, price=sv.price,
+                    resource_type=sv.resource_type, duration_minutes=sv.duration_minutes or 0,
+                    duration_days=sv.duration_days or 0, is_addon=bool(sv.is_addon),
+                    description=sv.description or ""
+                ) for sv in s.scalars(select(Service)).all()]
+            _catalog = Catalog(_catalog_version, records)
+        return _catalog
 
 def seed_services():
     with SASession(engine) as s:
         existing = {sv.code for sv in s.scalars(select(Service)).all()}
+        added = False
         for svc in SEED_SERVICES:
             if svc["code"] not in existing:
                 s.add(Service(**svc))
+                added = True
         s.commit()
-
-seed_services()
+    if added:
+        invalidate_catalog()
 
 # ------------ Helpers ------------
+class BusinessCalendar:
+    """Business hours laid out as one continuous count of open minutes ("ordinals").
+
+    Per-day windows (and so their UTC offsets) are localized once and cached, and
+    cumulative tables make end-time arithmetic and open-day lookups a bisect
+    instead of a day-by-day walk. Tables are rebuilt wider on demand and swapped
+    in whole, so readers never see a half-built table.
+    """
+    CHUNK_DAYS = 366
+    # A table never spans more than this: a date far from the current one starts a new table
+    MAX_TABLE_DAYS = 3 * CHUNK_DAYS
+
+    def __init__(self, hours: dict, closed=()):
+        self.hours = hours
+        self.closed = frozenset(closed)
+        self.window = lru_cache(maxsize=4096)(self._window)
+        self._lock = threading.Lock()
+        # (base date, open minutes before day base+i, open days before day base+i)
+        self._tables = (None, [0], [0])
+
+    def _window(self, d: date):
+        wh = self.hours.get(d.weekday(), (None, None))
+        if d in self.closed or wh[0] is None or wh[1] is None:
+            return None
+        return (SHOP_TZ.localize(datetime.combine(d, time(wh[0], 0))),
+                SHOP_TZ.localize(datetime.combine(d, time(wh[1], 0))))
+
+    def _covering(self, first: date, last: date):
+        """Tables covering at least first..last."""
+        tables = self._tables
+        base, minutes, _ = tables
+        if base is not None and base <= first and last < base + timedelta(days=len(minutes) - 1):
+            return tables
+        with self._lock:
+            base, minutes, _ = self._tables
+            if base is not None:
+                top = base + timedelta(days=len(minutes) - 2)
+                # Widen the current table for nearby dates, but build just around a distant one
+                # rather than every day in between
+                if (max(last, top) - min(first, base)).days <= self.MAX_TABLE_DAYS:
+                    first, last = min(first, base), max(last, top)
+            first -= timedelta(days=self.CHUNK_DAYS // 12)
+            last += timedelta(days=self.CHUNK_DAYS)
+            minutes, opened = [0], [0]
+            for i in range((last - first).days + 1):
+                bw = self.window(first + timedelta(days=i))
+                minutes.append(minutes[-1] + (int((bw[1] - bw[0]).total_seconds() // 60) if bw else 0))
+                opened.append(opened[-1] + (1 if bw else 0))
+            self._tables = (first, minutes, opened)
+            return self._tables
+
+    def is_open(self, d: date) -> bool:
+        return self.window(d) is not None
+
+    def nth_open_day(self, d: date, n: int) -> date:
+        """The n-th open day counting from d (n=1: d itself if open, else the next open day)."""
+        tables = self._covering(d, d + timedelta(days=1))
+        for _ in range(8):
+            base, _, opened = tables
+            rank = opened[(d - base).days] + n - 1
+            if opened[-1] > rank:
+                # The last index with `rank` open days before it is the open day of that rank
+                return base + timedelta(days=bisect_right(opened, rank) - 1)
+            tables = self._covering(d, base + timedelta(days=len(opened) - 1))
+        raise ValueError("BUSINESS_HOURS has no open days")
+
+    def next_open_day(self, d: date) -> date:
+        return self.nth_open_day(d + timedelta(days=1), 1)
+
+    def next_open_moment(self, dt_local: datetime) -> datetime:
+        """dt_local if the shop is open then, else the next opening time."""
+        bw = self.window(dt_local.date())
+        if bw is not None and dt_local < bw[1]:
+            return max(dt_local, bw[0])
+        return self.window(self.next_open_day(dt_local.date()))[0]
+
+    def ordinal(self, dt_local: datetime, tables=None) -> float:
+        """Business minutes from the table base to dt_local, clamped into open hours."""
+        d = dt_local.date()
+        base, minutes, _ = tables or self._covering(d, d)
+        idx = (d - base).days
+        bw = self.window(d)
+        if bw is None or dt_local <= bw[0]:
+            return minutes[idx]
+        if dt_local >= bw[1]:
+            return minutes[idx + 1]
+        return minutes[idx] + (dt_local - bw[0]).total_seconds() / 60
+
+    def end_time(self, start_local: datetime, add_minutes: int, add_days: int) -> datetime:
+        cur = start_local
+        # Multi-day part: the start day (or the next open one) counts as day one
+        if add_days > 0:
+            cur = self.window(self.nth_open_day(cur.date(), add_days))[1]
+        # Minute part: only open minutes count
+        if add_minutes > 0:
+            d = cur.date()
+            tables = self._covering(d, d + timedelta(days=add_minutes // (24 * 60) + 7))
+            target = self.ordinal(cur, tables) + add_minutes
+            while tables[1][-1] < target:
+                tables = self._covering(d, tables[0] + timedelta(days=len(tables[1]) - 1))
+            base, minutes, _ = tables
+            # A day boundary maps to the close of the earlier day, not the next opening
+            idx = bisect_left(minutes, target) - 1
+            cur = self.window(base + timedelta(days=idx))[0] + timedelta(minutes=target - minutes[idx])
+        return cur
+
+CALENDAR = BusinessCalendar(BUSINESS_HOURS, CLOSED_DATES)
+
 def is_open_on(dt_local: datetime) -> bool:
-    h = BUSINESS_HOURS.get(dt_local.weekday(), (None, None))
-    return h != (None, None) and h[0] is not None and h[1] is not None
+    return CALENDAR.is_open(dt_local.date())
 
 def business_window(dt_local_date: date):
-    wh = BUSINESS_HOURS.get(dt_local_date.weekday(), (None, None))
-    if wh[0] is None or wh[1] is None:
-        return None
-    start_naive = datetime.combine(dt_local_date, time(wh[0], 0))
-    end_naive = datetime.combine(dt_local_date, time(wh[1], 0))
-    start = SHOP_TZ.localize(start_naive)
-    end = SHOP_TZ.localize(end_naive)
-    return start, end
+    return CALENDAR.window(dt_local_date)
 
 
 def to_local(dt_utc: datetime) -> datetime:
@@ -146,21 +809,105 @@ def to_utc(dt_local: datetime) -> datetime:
 def overlaps(a_start, a_end, b_start, b_end) -> bool:
     return a_start < b_end and b_start < a_end
 
-def count_overlaps(resource_type: str, start_utc: datetime, end_utc: datetime) -> int:
+def as_utc(dt: datetime) -> datetime:
+    # SQLite hands back naive datetimes for DateTime(timezone=True); they are stored as UTC
+    if dt.tzinfo is None:
+        return pytz.utc.localize(dt)
+    return dt.astimezone(pytz.utc)
+
+def fits_capacity(resource_type: str, start_utc: datetime, end_utc: datetime, occupancy=None) -> bool:
+    # Capacity is about how many cars are in the bays at the same moment, not how many
+    # bookings touch the window: two back-to-back washes only ever need one bay.
+    if occupancy is None:
+        occupancy = load_occupancy(start_utc, end_utc, [resource_type])
+    peak = occupancy.get(resource_type, EMPTY_TIMELINE).peak_concurrency(start_utc, end_utc)
+    return peak < RESOURCE_CAPACITY.get(resource_type, 1)
+
+# ------------ Occupancy index ------------
+class ResourceTimeline:
+    """Booked intervals of one resource type, sorted by start (UTC)."""
+    __slots__ = ("starts", "ends", "max_len")
+
+    def __init__(self, intervals=()):
+        ordered = sorted(intervals)
+        self.starts = [st for st, _ in ordered]
+        self.ends = [en for _, en in ordered]
+        self.max_len = max((en - st for st, en in ordered), default=timedelta(0))
+
+    def add(self, start_utc: datetime, end_utc: datetime):
+        i = bisect_right(self.starts, start_utc)
+        self.starts.insert(i, start_utc)
+        self.ends.insert(i, end_utc)
+        self.max_len = max(self.max_len, end_utc - start_utc)
+
+    def overlapping(self, start_utc: datetime, end_utc: datetime):
+        # Only intervals starting within max_len before the window can reach into it
+        lo = bisect_left(self.starts, start_utc - self.max_len)
+        hi = bisect_left(self.starts, end_utc)
+        for i in range(lo, hi):
+            if self.ends[i] > start_utc:
+                yield self.starts[i], self.ends[i]
+
+    def peak_concurrency(self, start_utc: datetime, end_utc: datetime) -> int:
+        """Most intervals running at the same instant inside [start_utc, end_utc)."""
+        events = []
+        for st, en in self.overlapping(start_utc, end_utc):
+            events.append((max(st, start_utc), 1))
+            events.append((min(en, end_utc), -1))
+        # -1 sorts before +1 at equal times: a car leaving frees the bay for the next one
+        events.sort()
+        peak = cur = 0
+        for _, delta in events:
+            cur += delta
+            peak = max(peak, cur)
+        return peak
+
+    def first_conflict(self, start_utc: datetime, end_utc: datetime, capacity: int):
+        """(instant, release) for the first moment in the window where `capacity` bays are
+        already taken, with the earliest time one of those bookings ends; None if it fits."""
+        overlapping = list(self.overlapping(start_utc, end_utc))
+        events = []
+        for st, en in overlapping:
+            events.append((max(st, start_utc), 1))
+            events.append((min(en, end_utc), -1))
+        events.sort()
+        cur = 0
+        for at, delta in events:
+            cur += delta
+            if cur >= capacity:
+                return at, min(en for st, en in overlapping if st <= at < en)
+        return None
+
+    def busy_seconds(self, start_utc: datetime, end_utc: datetime) -> float:
+        """Bay-seconds booked inside [start_utc, end_utc): concurrency integrated over the window."""
+        return sum((min(en, end_utc) - max(st, start_utc)).total_seconds()
+                   for st, en in self.overlapping(start_utc, end_utc))
+
+EMPTY_TIMELINE = ResourceTimeline()
+
+# No visit (so no segment) may run longer than this. It gives the segment scan a lower bound
+# on start_utc, the database-side counterpart of ResourceTimeline.max_len: without it the
+# window index seeks on start_utc < end only and walks every past segment of the resource.
+MAX_SEGMENT_SPAN = timedelta(days=int(os.environ.get("MAX_SEGMENT_DAYS", "31")))
+
+def load_occupancy(start_utc: datetime, end_utc: datetime, resource_types=None) -> dict:
+    """One range query -> {resource_type: ResourceTimeline} for every live segment touching the window."""
+    conds = [Appointment.status != "canceled",
+             AppointmentSegment.start_utc > start_utc - MAX_SEGMENT_SPAN,
+             AppointmentSegment.start_utc < end_utc,
+             AppointmentSegment.end_utc > start_utc]
+    if resource_types is not None:
+        conds.append(AppointmentSegment.resource_type.in_(sorted(set(resource_types))))
+    intervals = {}
     with SASession(engine) as s:
-        q = s.scalars(select(Appointment).where(
-            and_(Appointment.resource_type == resource_type,
-                 Appointment.status != "canceled",
-                 Appointment.start_utc < end_utc,
-                 Appointment.end_utc > start_utc
-            )
-        ))
-        return len(list(q))
-
-def fits_capacity(resource_type: str, start_utc: datetime, end_utc: datetime) -> bool:
-    return count_overlaps(resource_type, start_utc, end_utc) < RESOURCE_CAPACITY.get(resource_type, 1)
-
-def compute_total_and_duration(primary: Service, addons: list[Service]):
+        rows = s.execute(select(AppointmentSegment.resource_type, AppointmentSegment.start_utc, AppointmentSegment.end_utc)
+                         .join(Appointment, Appointment.id == AppointmentSegment.appointment_id)
+                         .where(and_(*conds)))
+        for rt, st, en in rows:
+            intervals.setdefault(rt, []).append((as_utc(st), as_utc(en)))
+    return {rt: ResourceTimeline(ivs) for rt, ivs in intervals.items()}
+
+def compute_total_and_duration(primary: ServiceRecord, addons: list[ServiceRecord]):
     total_price = primary.price + sum(a.price for a in addons)
     # Duration: base = primary, add-ons add their own but only hours add-ons for simplicity
     dur_minutes = primary.duration_minutes
@@ -171,55 +918,14 @@ def compute_total_and_duration(primary: Service, addons: list[Service]):
     return total_price, dur_minutes, dur_days
 
 def next_business_day(d: date) -> date:
-    # advance until a day with business window
-    for i in range(1, 8):
-        nd = d + timedelta(days=1)
-        bw = business_window(nd)
-        if bw is not None:
-            return nd
-        d = nd
-    return d
+    return CALENDAR.next_open_day(d)
 
+@timed("end_time_for_span")
 def end_time_for_span(start_local: datetime, add_minutes: int, add_days: int) -> datetime:
-    cur = start_local
-    # Multi-day part: consume whole business days
-    if add_days > 0:
-        remaining_days = add_days
-        while remaining_days > 0:
-            bw = business_window(cur.date())
-            if not bw:
-                nd = next_business_day(cur.date())
-                bw = business_window(nd)
-            start_day, end_day = bw
-            remaining_days -= 1
-            if remaining_days == 0:
-                cur = end_day
-                break
-            nd = next_business_day(cur.date())
-            cur = business_window(nd)[0]
-
-    # Minute part: walk inside business hours
-    remaining = add_minutes
-    while remaining > 0:
-        bw = business_window(cur.date())
-        if not bw:
-            nd = next_business_day(cur.date())
-            bw = business_window(nd)
-        start_day, end_day = bw
-        if cur < start_day:
-            cur = start_day
-        available = int((end_day - cur).total_seconds() // 60)
-        if available <= 0:
-            nd = next_business_day(cur.date())
-            cur = business_window(nd)[0]
-            continue
-        step = min(remaining, available)
-        cur = cur + timedelta(minutes=step)
-        remaining -= step
-    return cur
+    return CALENDAR.end_time(start_local, add_minutes, add_days)
 
 
-def slot_candidates_for_date(service: Service, day: date):
+def slot_candidates_for_date(service: ServiceRecord, day: date):
     """Return list of local datetimes that can start on given day"""
     bw = business_window(day)
     if not bw:
@@ -238,65 +944,826 @@ def slot_candidates_for_date(service: Service, day: date):
             cur += step
     return slots
 
-def available_slots(service: Service, day: date, addons: list[Service]):
+# Add-ons are placed on this grid, counted from the appointment start (a multiple of the ledger bucket)
+ADDON_STEP = timedelta(minutes=15)
+ADDON_PLACEMENT_STEPS = 200
+
+def place_addon(addon: ServiceRecord, start_local: datetime, visit_end_utc: datetime, placed: list, occupancy: dict):
+    """Earliest (resource_type, start_utc, end_utc) for an add-on inside the visit, or None.
+
+    The add-on may run alongside work on other bays but not on top of this car's
+    own segments on the same resource. A collision jumps to when the blocking
+    booking ends rather than trying every grid step.
+    """
+    rt = addon.resource_type
+    timeline = occupancy.get(rt, EMPTY_TIMELINE)
+    cap = RESOURCE_CAPACITY.get(rt, 1)
+    cur = start_local
+    for _ in range(ADDON_PLACEMENT_STEPS):
+        st = to_utc(cur)
+        en = to_utc(end_time_for_span(cur, addon.duration_minutes, addon.duration_days))
+        if en > visit_end_utc:
+            return None
+        own = [e for r, s_, e in placed if r == rt and s_ < en and e > st]
+        if own:
+            resume = to_local(max(own))
+        else:
+            hit = timeline.first_conflict(st, en, cap)
+            if hit is None:
+                return rt, st, en
+            resume = cur + max(hit[1] - hit[0], ADDON_STEP)
+        steps = -((start_local - resume) // ADDON_STEP)
+        cur = CALENDAR.next_open_moment(start_local + steps * ADDON_STEP)
+    return None
+
+def plan_segments(service: ServiceRecord, addons: list[ServiceRecord], start_local: datetime, end_local: datetime, occupancy: dict):
+    """Per-resource segments for a visit from start_local to end_local, or None if it cannot be packed.
+
+    The primary service starts with the visit; each add-on then takes the earliest
+    gap on its own resource that still finishes before the car is due back.
+    """
+    if to_utc(end_local) - to_utc(start_local) > MAX_SEGMENT_SPAN:
+        return None  # load_occupancy could not see it; no catalog service comes close
+    primary_end = end_time_for_span(start_local, service.duration_minutes, service.duration_days)
+    segments = [(service.resource_type, to_utc(start_local), to_utc(primary_end))]
+    if not fits_capacity(*segments[0], occupancy):
+        return None
+    visit_end_utc = to_utc(end_local)
+    for a in addons:
+        seg = place_addon(a, start_local, visit_end_utc, segments, occupancy)
+        if seg is None:
+            return None
+        segments.append(seg)
+    return segments
+
+def occupancy_for_visits(service: ServiceRecord, addons: list[ServiceRecord], visits) -> dict:
+    """Occupancy covering every (start_local, end_local) visit in one query."""
+    return load_occupancy(to_utc(min(v[0] for v in visits)), to_utc(max(v[1] for v in visits)),
+                          {service.resource_type, *(a.resource_type for a in addons)})
+
+@timed("available_slots")
+def available_slots_for_days(service: ServiceRecord, days: list[date], addons: list[ServiceRecord], occupancy=None) -> dict:
+    """{day: [(start_local, end_local), ...]} for several days, sharing one occupancy load."""
     total_price, add_minutes, add_days = compute_total_and_duration(service, addons)
-    slots = []
-    for start_local in slot_candidates_for_date(service, day):
-        # compute end across business hours
+    # Work out every candidate's visit first so occupancy can be loaded in one query
+    candidates = []
+    for day in days:
+        for start_local in slot_candidates_for_date(service, day):
+            # compute end across business hours
+            candidates.append((day, start_local, end_time_for_span(start_local, add_minutes, add_days)))
+    result = {day: [] for day in days}
+    if not candidates:
+        return result
+    if occupancy is None:
+        occupancy = occupancy_for_visits(service, addons, [c[1:] for c in candidates])
+    for day, start_local, end_local in candidates:
+        if plan_segments(service, addons, start_local, end_local, occupancy) is not None:
+            result[day].append((start_local, end_local))
+    return result
+
+def available_slots(service: ServiceRecord, day: date, addons: list[ServiceRecord], occupancy=None):
+    return available_slots_for_days(service, [day], addons, occupancy)[day]
+
+def slot_json(start_local: datetime, end_local: datetime) -> dict:
+    return {
+        "start": to_utc(start_local).isoformat(),
+        "end": to_utc(end_local).isoformat(),
+        "label": start_local.strftime("%I:%M %p") + " → " + end_local.strftime("%I:%M %p")
+    }
+
+# How far ahead /api/availability/next looks, and how many starts it may test
+NEXT_SEARCH_DAYS = 60
+NEXT_SEARCH_STEPS = 5000
+SLOT_STEP = timedelta(minutes=30)
+
+def next_available_slots(service: ServiceRecord, addons: list[ServiceRecord], count: int, now_local: datetime = None):
+    """The earliest `count` feasible starts from now on, as (start_local, end_local).
+
+    A candidate that collides jumps straight past the booking blocking it (every
+    start before then would hit the same full bays) instead of stepping through
+    each 30-minute slot, and closed days are skipped via the business calendar.
+    """
+    now_local = now_local or datetime.now(SHOP_TZ)
+    total_price, add_minutes, add_days = compute_total_and_duration(service, addons)
+    horizon = now_local.date() + timedelta(days=NEXT_SEARCH_DAYS)
+    last_end = end_time_for_span(SHOP_TZ.localize(datetime.combine(horizon, time(23, 59))), add_minutes, add_days)
+    occupancy = load_occupancy(to_utc(now_local), to_utc(last_end),
+                               {service.resource_type, *(a.resource_type for a in addons)})
+
+    def first_start(day: date, not_before: datetime):
+        """First allowed start at or after not_before, moving on to later open days as needed."""
+        while day <= horizon:
+            candidates = slot_candidates_for_date(service, day)
+            if candidates:
+                # candidates are opening + k * SLOT_STEP (just the opening for multi-day work)
+                k = max(0, -((candidates[0] - not_before) // SLOT_STEP))
+                if k < len(candidates):
+                    return candidates[k]
+            day = next_business_day(day)
+        return None
+
+    found = []
+    start_local = first_start(now_local.date(), now_local)
+    steps = 0
+    while start_local is not None and len(found) < count and steps < NEXT_SEARCH_STEPS:
+        steps += 1
         end_local = end_time_for_span(start_local, add_minutes, add_days)
-        start_utc = to_utc(start_local)
-        end_utc = to_utc(end_local)
-        # Check capacity on primary resource and also on addon resources if different
-        ok = fits_capacity(service.resource_type, start_utc, end_utc)
-        if ok:
-            # For each addon with distinct resource, we must also check capacity
-            for a in addons:
-                if a.resource_type != service.resource_type or a.duration_days > 0:
-                    # naive approach: assume addons happen in parallel starting at same time
-                    a_end_local = end_time_for_span(start_local, a.duration_minutes, a.duration_days)
-                    if not fits_capacity(a.resource_type, to_utc(start_local), to_utc(a_end_local)):
-                        ok = False
-                        break
-        if ok:
-            slots.append((start_local, end_local))
-    return slots
+        primary_end = end_time_for_span(start_local, service.duration_minutes, service.duration_days)
+        skip = SLOT_STEP
+        hit = occupancy.get(service.resource_type, EMPTY_TIMELINE).first_conflict(
+            to_utc(start_local), to_utc(primary_end), RESOURCE_CAPACITY.get(service.resource_type, 1))
+        if hit is not None:
+            # Only the primary segment is pinned to the start, so only its collisions allow a jump
+            skip = max(skip, hit[1] - hit[0])
+        elif plan_segments(service, addons, start_local, end_local, occupancy) is not None:
+            found.append((start_local, end_local))
+        start_local = first_start(start_local.date(), start_local + skip)
+    return found
+
+# ------------ Reservation ledger ------------
+LEDGER_BUCKET_MINUTES = 15
+BOOKING_ATTEMPTS = 5
+APPOINTMENT_STATUSES = ("booked", "in_progress", "done", "canceled")
+
+class SlotTaken(Exception):
+    pass
+
+def lost_bay_race(exc: IntegrityError) -> bool:
+    """A concurrent booking claimed the same bay first (uq_reservation_unit)."""
+    msg = str(exc.orig)
+    # SQLite names the columns, PostgreSQL the constraint
+    return "uq_reservation_unit" in msg or "UNIQUE constraint failed: reservations." in msg
+
+def write_contention(exc: OperationalError) -> bool:
+    """The database was too busy to take the write; retrying may succeed."""
+    msg = str(exc.orig).lower()
+    return ("database is locked" in msg or "database table is locked" in msg
+            or getattr(exc.orig, "pgcode", None) in ("40001", "40P01"))  # serialization failure, deadlock
+
+def ledger_buckets(start_utc: datetime, end_utc: datetime) -> list[datetime]:
+    """UTC bucket starts covering [start_utc, end_utc), aligned to LEDGER_BUCKET_MINUTES."""
+    step = timedelta(minutes=LEDGER_BUCKET_MINUTES)
+    epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
+    cur = epoch + ((as_utc(start_utc) - epoch) // step) * step
+    buckets = []
+    while cur < end_utc:
+        buckets.append(cur)
+        cur += step
+    return buckets
+
+def reserve(s: SASession, appointment_id: int, spans, strict: bool = True):
+    """Claim the lowest free bay per bucket for every span, inside the caller's transaction.
+
+    Raises SlotTaken when a bucket is already full; a concurrent booking that
+    claimed the same unit first surfaces as IntegrityError on flush.
+    """
+    rows = []
+    for rt, st, en in spans:
+        buckets = ledger_buckets(st, en)
+        if not buckets:
+            continue
+        taken = {}
+        for b, unit in s.execute(select(Reservation.bucket, Reservation.unit).where(and_(
+                Reservation.resource_type == rt, Reservation.bucket >= buckets[0], Reservation.bucket <= buckets[-1]))):
+            taken.setdefault(as_utc(b), set()).add(unit)
+        for row in rows:
+            if row["resource_type"] == rt:
+                taken.setdefault(row["bucket"], set()).add(row["unit"])
+        cap = RESOURCE_CAPACITY.get(rt, 1)
+        for b in buckets:
+            used = taken.get(b, set())
+            unit = next((u for u in range(cap) if u not in used), None)
+            if unit is None:
+                if strict:
+                    raise SlotTaken(rt, b)
+                # Backfilling history that was already overbooked: record it past capacity
+                unit = max(used) + 1
+                app.logger.warning("ledger: %s over capacity at %s (appointment %s)", rt, b, appointment_id)
+            rows.append({"appointment_id": appointment_id, "resource_type": rt, "bucket": b, "unit": unit})
+    if rows:
+        s.execute(insert(Reservation), rows)
+        s.flush()
+
+def release(s: SASession, appointment_id: int):
+    s.execute(delete(Reservation).where(Reservation.appointment_id == appointment_id))
+
+def legacy_spans(a) -> list:
+    """How appointments booked before segments existed held bays: the whole visit on the
+    primary resource, plus other-resource add-ons in parallel from the start."""
+    cat = get_catalog()
+    try:
+        addons = cat.lookup(json.loads(a.addon_codes or "[]"))
+    except ValueError:
+        addons = []
+    start_utc, end_utc = as_utc(a.start_utc), as_utc(a.end_utc)
+    spans = [(a.resource_type, start_utc, end_utc)]
+    for addon in addons:
+        if addon.resource_type != a.resource_type or addon.duration_days > 0:
+            a_end = end_time_for_span(to_local(start_utc), addon.duration_minutes, addon.duration_days)
+            spans.append((addon.resource_type, start_utc, to_utc(a_end)))
+    return spans
+
+def appointment_spans(s: SASession, a) -> list:
+    """(resource_type, start_utc, end_utc) segments an appointment holds."""
+    rows = s.execute(select(AppointmentSegment.resource_type, AppointmentSegment.start_utc, AppointmentSegment.end_utc)
+                     .where(AppointmentSegment.appointment_id == a.id)).all()
+    if not rows:
+        return legacy_spans(a)
+    return [(rt, as_utc(st), as_utc(en)) for rt, st, en in rows]
+
+def store_segments(s: SASession, appointment_id: int, segments):
+    if any(en - st > MAX_SEGMENT_SPAN for _, st, en in segments):
+        app.logger.warning("appointment %s has a segment longer than MAX_SEGMENT_SPAN; occupancy will miss it", appointment_id)
+    s.execute(insert(AppointmentSegment), [
+        {"appointment_id": appointment_id, "resource_type": rt, "start_utc": st, "end_utc": en}
+        for rt, st, en in segments
+    ])
+
+def backfill_segments():
+    """Give upcoming appointments booked before segments existed their legacy segments."""
+    now = datetime.now(pytz.utc)
+    with SASession(engine) as s:
+        legacy = s.scalars(select(Appointment).where(and_(
+            Appointment.end_utc > now,
+            ~exists().where(AppointmentSegment.appointment_id == Appointment.id)
+        ))).all()
+        for a in legacy:
+            store_segments(s, a.id, legacy_spans(a))
+        s.commit()
+
+def backfill_reservations():
+    """Give upcoming appointments booked before the ledger existed their reservation rows."""
+    now = datetime.now(pytz.utc)
+    with SASession(engine) as s:
+        legacy = s.scalars(select(Appointment).where(and_(
+            Appointment.status != "canceled",
+            Appointment.end_utc > now,
+            ~exists().where(Reservation.appointment_id == Appointment.id)
+        )).order_by(Appointment.start_utc)).all()
+        for a in legacy:
+            reserve(s, a.id, appointment_spans(s, a), strict=False)
+        s.commit()
+
+# ------------ Appointment search ------------
+# One normalized document per appointment in appointment_search: SQLite keeps it in an FTS5
+# trigram table (rowid = appointment id), Postgres in a plain table with a pg_trgm GIN index.
+# Both answer substring queries ("321 010", "abc123", "neil") from the index, not a table scan.
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_BACKFILL_BATCH = 10000
+
+def _alnum(text: str) -> str:
+    return "".join(ch for ch in text.lower() if ch.isalnum())
+
+def search_document(customer_name: str, phone: str, car_info: str) -> str:
+    """Name and car words, the car text with separators dropped (so "ABC-123", "abc 123" and
+    "abc123" all match a plate) and the phone as bare digits."""
+    words = [_alnum(w) for w in f"{customer_name} {car_info}".split()]
+    return " ".join([w for w in words if w] + [_alnum(car_info), "".join(ch for ch in phone if ch.isdigit())])
+
+def search_terms(query: str) -> list[str]:
+    """Normalized terms, all of which must match. A query that looks like a phone number
+    becomes one run of digits; otherwise each word loses case and punctuation."""
+    stripped = query.strip()
+    if stripped and all(ch.isdigit() or ch in "+-(). " for ch in stripped):
+        terms = ["".join(ch for ch in stripped if ch.isdigit())]
+    else:
+        terms = [_alnum(w) for w in stripped.split()]
+    # Trigram indexes cannot look up anything shorter than three characters
+    return [t for t in terms if len(t) >= 3]
+
+class SqliteSearch:
+    def create(self, conn):
+        conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS appointment_search USING fts5(doc, tokenize='trigram')"))
+
+    def upsert(self, conn, docs):
+        conn.execute(text("DELETE FROM appointment_search WHERE rowid = :id"), [{"id": i} for i, _ in docs])
+        conn.execute(text("INSERT INTO appointment_search (rowid, doc) VALUES (:id, :doc)"),
+                     [{"id": i, "doc": d} for i, d in docs])
+
+    def missing_ids_sql(self):
+        return "SELECT id FROM appointments WHERE id NOT IN (SELECT rowid FROM appointment_search)"
+
+    def search(self, conn, terms, limit, offset):
+        # Each term is a quoted FTS5 string; adjacent strings are ANDed. bm25 is lower-is-better.
+        match = " ".join(f'"{t}"' for t in terms)
+        return conn.execute(text("SELECT rowid, bm25(appointment_search) AS rank FROM appointment_search "
+                                 "WHERE doc MATCH :match ORDER BY rank, rowid DESC LIMIT :limit OFFSET :offset"),
+                            {"match": match, "limit": limit, "offset": offset}).all()
+
+class PostgresSearch:
+    def create(self, conn):
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text("CREATE TABLE IF NOT EXISTS appointment_search (appointment_id INTEGER PRIMARY KEY, doc TEXT NOT NULL)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_appointment_search_trgm ON appointment_search USING gin (doc gin_trgm_ops)"))
+
+    def upsert(self, conn, docs):
+        conn.execute(text("INSERT INTO appointment_search (appointment_id, doc) VALUES (:id, :doc) "
+                          "ON CONFLICT (appointment_id) DO UPDATE SET doc = EXCLUDED.doc"),
+                     [{"id": i, "doc": d} for i, d in docs])
+
+    def missing_ids_sql(self):
+        return ("SELECT a.id FROM appointments a WHERE NOT EXISTS "
+                "(SELECT 1 FROM appointment_search s WHERE s.appointment_id = a.id)")
+
+    def search(self, conn, terms, limit, offset):
+        # ILIKE per term is answered from the GIN index; similarity() ranks closer documents first
+        # Terms are alphanumeric (see search_terms), so there are no LIKE wildcards to escape
+        params = {"q": " ".join(terms), "limit": limit, "offset": offset}
+        conds = []
+        for i, t in enumerate(terms):
+            params[f"t{i}"] = f"%{t}%"
+            conds.append(f"doc ILIKE :t{i}")
+        return conn.execute(text("SELECT appointment_id, similarity(doc, :q) AS rank FROM appointment_search "
+                                 f"WHERE {' AND '.join(conds)} ORDER BY rank DESC, appointment_id DESC "
+                                 "LIMIT :limit OFFSET :offset"), params).all()
+
+search_index = PostgresSearch() if engine.dialect.name == "postgresql" else SqliteSearch()
+
+def index_appointments(conn, appts):
+    """Add or refresh search documents for (id, customer_name, phone, car_info) rows."""
+    docs = [(i, search_document(n or "", p or "", c or "")) for i, n, p, c in appts]
+    if docs:
+        search_index.upsert(conn, docs)
+
+def backfill_search():
+    """Index appointments that have no search document yet (new installs, bulk imports)."""
+    with engine.connect() as conn:
+        missing = [row[0] for row in conn.execute(text(search_index.missing_ids_sql()))]
+    for i in range(0, len(missing), SEARCH_BACKFILL_BATCH):
+        batch = missing[i:i + SEARCH_BACKFILL_BATCH]
+        with engine.begin() as conn:
+            rows = conn.execute(select(Appointment.id, Appointment.customer_name, Appointment.phone, Appointment.car_info)
+                                .where(Appointment.id.in_(batch))).all()
+            index_appointments(conn, rows)
+
+# ------------ Appointment archive ------------
+# Scheduling only looks at current and future rows, so finished appointments older than
+# ARCHIVE_AFTER_DAYS move to appointments_archive (run `flask --app app archive` from cron),
+# and segment/reservation rows that ended before then are dropped whatever the appointment's
+# status (a past booking nobody marked done still holds them otherwise). The live tables
+# then stay the size of the booking window however much history builds up. Reads by id and
+# the report/feed queries below look in both appointment tables.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", "5000"))
+ARCHIVE_STATUSES = ("done", "canceled")
+APPOINTMENT_TABLES = (Appointment, ArchivedAppointment)
+
+def get_appointment(s: SASession, appt_id: int):
+    """The appointment with this id, live or archived (archived rows are read-only)."""
+    return s.get(Appointment, appt_id) or s.get(ArchivedAppointment, appt_id)
+
+def appointment_tables(s: SASession, since: datetime | None = None):
+    """The live table, plus the archive unless everything archived ended before since."""
+    if since is None:
+        return APPOINTMENT_TABLES
+    newest_end = s.scalar(select(func.max(ArchivedAppointment.end_utc)))
+    if newest_end is None or as_utc(newest_end) <= since:
+        return (Appointment,)
+    return APPOINTMENT_TABLES
+
+def all_appointments(build, tables=APPOINTMENT_TABLES):
+    """build(model) -> select, run against each table and combined into one subquery.
+    Give build its own order_by/limit when the caller pages, so each table stops early."""
+    return union_all(*(select(build(M).subquery()) for M in tables)).subquery()
+
+def archive_appointments(older_than_days: int = ARCHIVE_AFTER_DAYS, batch: int = ARCHIVE_BATCH) -> int:
+    """Move done/canceled appointments that ended more than older_than_days ago into the archive,
+    a batch per transaction so bookings are not held up. Returns how many rows moved."""
+    now = datetime.now(pytz.utc)
+    cutoff = now - timedelta(days=older_than_days)
+    names = [c.name for c in Appointment.__table__.columns]
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            # SQLite hands out max(rowid) + 1, so the newest row stays to keep archived ids from being reused
+            newest = conn.scalar(select(func.max(Appointment.id)))
+            eligible = and_(Appointment.status.in_(ARCHIVE_STATUSES), Appointment.end_utc < cutoff,
+                            Appointment.id < newest)
+            ids = conn.scalars(select(Appointment.id).where(eligible).order_by(Appointment.id)
+                               .limit(batch).with_for_update(skip_locked=True)).all()
+            if not ids:
+                return moved
+            # Conditions are checked again by the insert, which is what takes SQLite's write lock
+            conn.execute(insert(ArchivedAppointment).from_select(
+                names + ["archived_at"],
+                select(*[Appointment.__table__.c[n] for n in names], literal(now, DateTime(timezone=True)))
+                .where(Appointment.id.in_(ids), eligible)))
+            ids = conn.scalars(select(ArchivedAppointment.id).where(ArchivedAppointment.id.in_(ids))).all()
+            conn.execute(delete(Reservation).where(Reservation.appointment_id.in_(ids)))
+            conn.execute(delete(AppointmentSegment).where(AppointmentSegment.appointment_id.in_(ids)))
+            conn.execute(delete(Appointment).where(Appointment.id.in_(ids)))
+        moved += len(ids)
+
+def prune_schedule(older_than_days: int = ARCHIVE_AFTER_DAYS, batch: int = ARCHIVE_BATCH) -> int:
+    """Delete segment and reservation rows that ended more than older_than_days ago. Only
+    future windows are ever checked against them. Returns how many rows went."""
+    cutoff = datetime.now(pytz.utc) - timedelta(days=older_than_days)
+    bucket = timedelta(minutes=LEDGER_BUCKET_MINUTES)
+    # Per resource type, so both scans seek on the (resource_type, start) indexes
+    stale = [(AppointmentSegment, lambda rt: and_(AppointmentSegment.resource_type == rt,
+                                                  AppointmentSegment.start_utc < cutoff,
+                                                  AppointmentSegment.end_utc < cutoff)),
+             (Reservation, lambda rt: and_(Reservation.resource_type == rt, Reservation.bucket < cutoff - bucket))]
+    pruned = 0
+    for model, cond in stale:
+        for rt in RESOURCE_CAPACITY:
+            while True:
+                with engine.begin() as conn:
+                    ids = select(model.id).where(cond(rt)).limit(batch).scalar_subquery()
+                    n = conn.execute(delete(model).where(model.id.in_(ids))).rowcount
+                pruned += n
+                if n < batch:
+                    break
+    return pruned
+
+@app.cli.command("archive")
+@click.option("--older-than", type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Archive done/canceled appointments that ended more than this many days ago.")
+def archive_command(older_than):
+    """Move finished appointments out of the live table, drop past schedule rows and old sent notifications."""
+    moved = archive_appointments(older_than)
+    pruned = prune_schedule(older_than)
+    purged = purge_outbox()
+    click.echo(f"archived {moved} appointments, pruned {pruned} segment/reservation rows, "
+               f"purged {purged} sent notifications")
+
+# ------------ Database setup ------------
+def backfill_sequences():
+    """Give appointments from before seq existed (or bulk-loaded ones) a change-log entry and seq."""
+    now = datetime.now(pytz.utc)
+    of_appt = AppointmentChange.appointment_id == Appointment.id
+    with engine.begin() as conn:
+        conn.execute(insert(AppointmentChange).from_select(
+            ["appointment_id", "changed_at"],
+            select(Appointment.id, literal(now, DateTime(timezone=True)))
+            .where(Appointment.seq.is_(None), ~exists().where(of_appt))))
+        conn.execute(update(Appointment).where(Appointment.seq.is_(None)).values(
+            seq=select(func.max(AppointmentChange.id)).where(of_appt).scalar_subquery(),
+            revision=select(func.count(AppointmentChange.id) - 1).where(of_appt).scalar_subquery()))
+
+def init_db() -> list[int]:
+    """Migrate the schema, seed services and backfill derived rows. Safe to run on every deploy."""
+    with migration_lock():
+        applied = migrate()
+        seed_services()
+        backfill_segments()
+        backfill_reservations()
+        backfill_search()
+        backfill_sequences()
+    return applied
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the database (run once per deploy, before starting workers)."""
+    applied = init_db()
+    click.echo(f"schema at version {SCHEMA_VERSION}" + (f", applied {applied}" if applied else ", already up to date"))
+
+def warm_start():
+    """Import-time check for workers: no DDL, just the schema version and a warm catalog."""
+    if os.environ.get("DB_AUTO_MIGRATE") == "1":
+        init_db()
+    with engine.connect() as conn:
+        version = schema_version(conn)
+    if version < SCHEMA_VERSION:
+        app.logger.warning("database schema is at version %s, expected %s; run `flask --app app init-db`", version, SCHEMA_VERSION)
+        return
+    get_catalog()
+
+warm_start()
+
+# ------------ Availability cache ------------
+def database_identity() -> str:
+    """Short hash naming the database this process serves (SQLite paths made absolute)."""
+    url = engine.url
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        url = url.set(database=os.path.abspath(url.database))
+    return hashlib.sha1(url.render_as_string(hide_password=False).encode()).hexdigest()[:12]
+
+# A file path (shared by every worker on the host), "memory" (per process) or "off". The default
+# file is per database, so deployments sharing a host never see each other's slots or invalidations.
+AVAILABILITY_CACHE = os.environ.get(
+    "AVAILABILITY_CACHE", os.path.join(tempfile.gettempdir(), f"carshop-availability-{database_identity()}.sqlite"))
+AVAILABILITY_CACHE_TTL = int(os.environ.get("AVAILABILITY_CACHE_TTL", "300"))
+AVAILABILITY_CACHE_MAX = int(os.environ.get("AVAILABILITY_CACHE_MAX", "5000"))
+
+# Anything that changes slot maths without touching the database must change cache keys
+CONFIG_FINGERPRINT = hashlib.sha1(json.dumps(
+    [TZ_NAME, sorted(BUSINESS_HOURS.items()), sorted(map(str, CLOSED_DATES)), sorted(RESOURCE_CAPACITY.items())]
+).encode()).hexdigest()[:12]
+
+# Every invalidation bumps a generation per (resource_type, day). A result computed while one
+# of its days was invalidated is stale (it may predate the booking) and is not stored.
+
+class MemoryCacheStore:
+    """Per-process LRU with TTL."""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl, self.max_entries = ttl, max_entries
+        self._entries = OrderedDict()  # key -> (expires, value, deps)
+        self._generations = {}  # (resource_type, day) -> invalidation count
+        self._lock = threading.Lock()
+
+    def generations(self, deps) -> dict:
+        with self._lock:
+            return {dep: self._generations.get(dep, 0) for dep in deps}
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: str, deps, seen: dict) -> bool:
+        with self._lock:
+            if any(self._generations.get(dep, 0) != gen for dep, gen in seen.items()):
+                return False
+            self._entries[key] = (monotonic() + self.ttl, value, set(deps))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate(self, resource_type: str, days):
+        days = {d.isoformat() for d in days}
+        with self._lock:
+            for d in days:
+                self._generations[(resource_type, d)] = self._generations.get((resource_type, d), 0) + 1
+            for key in [k for k, (_, _, deps) in self._entries.items()
+                        if any(rt == resource_type and d in days for rt, d in deps)]:
+                del self._entries[key]
+
+class SQLiteCacheStore:
+    """TTL cache in a local SQLite file so every worker on the host shares entries and invalidations."""
+
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self.path, self.ttl, self.max_entries = path, ttl, max_entries
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_entries_expires ON entries (expires);
+                CREATE TABLE IF NOT EXISTS deps (key TEXT NOT NULL, resource_type TEXT NOT NULL, day TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS ix_deps_lookup ON deps (resource_type, day);
+                CREATE INDEX IF NOT EXISTS ix_deps_key ON deps (key);
+                CREATE TABLE IF NOT EXISTS generations (resource_type TEXT NOT NULL, day TEXT NOT NULL,
+                                                        gen INTEGER NOT NULL, PRIMARY KEY (resource_type, day));
+            """)
+
+    def _conn(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key: str):
+        row = self._conn().execute("SELECT value FROM entries WHERE key = ? AND expires > ?", (key, wall_clock())).fetchone()
+        return row[0] if row else None
+
+    def _read_generations(self, conn, deps) -> dict:
+        seen = dict.fromkeys(deps, 0)
+        for rt, day, gen in conn.execute("SELECT resource_type, day, gen FROM generations WHERE day IN (%s)"
+                                         % ",".join("?" * len({d for _, d in deps})), sorted({d for _, d in deps})):
+            if (rt, day) in seen:
+                seen[(rt, day)] = gen
+        return seen
+
+    def generations(self, deps) -> dict:
+        return self._read_generations(self._conn(), deps) if deps else {}
+
+    def set(self, key: str, value: str, deps, seen: dict) -> bool:
+        conn = self._conn()
+        now = wall_clock()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if seen and self._read_generations(conn, list(seen)) != seen:
+                return False
+            conn.execute("DELETE FROM deps WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)", (key, value, now + self.ttl))
+            conn.executemany("INSERT INTO deps (key, resource_type, day) VALUES (?, ?, ?)", [(key, rt, d) for rt, d in deps])
+            # Expired rows go first, then the entries closest to expiry
+            excess = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+            evicted = conn.execute("DELETE FROM entries WHERE expires <= ? OR key IN (SELECT key FROM entries ORDER BY expires LIMIT ?)",
+                                   (now, max(excess, 0))).rowcount
+            if evicted:
+                conn.execute("DELETE FROM deps WHERE key NOT IN (SELECT key FROM entries)")
+        return True
+
+    def invalidate(self, resource_type: str, days):
+        days = [d.isoformat() for d in days]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO generations (resource_type, day, gen) VALUES (?, ?, 1) "
+                             "ON CONFLICT (resource_type, day) DO UPDATE SET gen = gen + 1",
+                             [(resource_type, d) for d in days])
+            marks = ",".join("?" * len(days))
+            keys = [r[0] for r in conn.execute(
+                f"SELECT DISTINCT key FROM deps WHERE resource_type = ? AND day IN ({marks})", [resource_type, *days])]
+            for key in keys:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                conn.execute("DELETE FROM deps WHERE key = ?", (key,))
+
+class AvailabilityCache:
+    """Cache in front of available_slots(); identical concurrent misses share one computation."""
+
+    def __init__(self, store):
+        self.store = store
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: str, compute, deps_for):
+        """deps_for() -> the (resource_type, ISO day) pairs whose bookings the result depends on."""
+        if self.store is None:
+            return compute()
+        value = self.store.get(key)
+        if value is not None:
+            return json.loads(value)
+        with self._lock:
+            done = self._inflight.get(key)
+            leader = done is None
+            if leader:
+                done = self._inflight[key] = threading.Event()
+        if not leader:
+            # Someone is already computing this key: wait for them instead of piling onto the DB
+            done.wait(10)
+            value = self.store.get(key)
+            if value is not None:
+                return json.loads(value)
+            return compute()
+        try:
+            # Read before computing: an invalidation landing mid-compute then shows up as a change
+            deps = deps_for()
+            seen = self.store.generations(deps)
+            result = compute()
+            self.store.set(key, json.dumps(result), deps, seen)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            done.set()
+
+    def invalidate_spans(self, spans):
+        """Drop entries whose slots could touch any (resource_type, start_utc, end_utc) span."""
+        if self.store is None:
+            return
+        for rt, st, en in spans:
+            first, last = to_local(st).date(), to_local(en).date()
+            self.store.invalidate(rt, [first + timedelta(days=i) for i in range((last - first).days + 1)])
+
+def make_availability_cache() -> AvailabilityCache:
+    if AVAILABILITY_CACHE == "off":
+        return AvailabilityCache(None)
+    if AVAILABILITY_CACHE == "memory":
+        return AvailabilityCache(MemoryCacheStore(AVAILABILITY_CACHE_TTL, AVAILABILITY_CACHE_MAX))
+    return AvailabilityCache(SQLiteCacheStore(AVAILABILITY_CACHE, AVAILABILITY_CACHE_TTL, AVAILABILITY_CACHE_MAX))
+
+availability_cache = make_availability_cache()
+
+def cached_available_slots(service: ServiceRecord, day: date, addons: list[ServiceRecord]) -> list[dict]:
+    """available_slots() for one day, JSON-ready, through availability_cache."""
+    cat = get_catalog()
+    key = ":".join([CONFIG_FINGERPRINT, cat.fingerprint, service.code, ",".join(sorted(a.code for a in addons)), day.isoformat()])
+
+    def compute():
+        return [slot_json(st, en) for st, en in available_slots(service, day, addons)]
+
+    def deps_for():
+        # Slots starting on `day` can run into later days; the latest any candidate could end
+        # is bounded by a start at closing time.
+        bw = business_window(day)
+        last = day
+        if bw is not None:
+            _, add_minutes, add_days = compute_total_and_duration(service, addons)
+            last = end_time_for_span(bw[1], add_minutes, add_days).date()
+        days = [(day + timedelta(days=i)).isoformat() for i in range((last - day).days + 1)]
+        return [(rt, d) for rt in {service.resource_type, *(a.resource_type for a in addons)} for d in days]
+
+    return availability_cache.get_or_compute(key, compute, deps_for)
+
+# ------------ Static assets ------------
+# build_assets.py writes content-hashed copies (plus .gz/.br) to static/dist and a manifest.
+# With a manifest, url_for('static', ...) points at the hashed file, served as immutable;
+# without one, static/ is served as-is and templates fall back to the Tailwind CDN.
+ASSET_DIST = os.path.join(app.static_folder, "dist")
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+def load_asset_manifest() -> dict:
+    try:
+        with open(os.path.join(ASSET_DIST, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": {}, "variants": {}, "build": None}
+
+asset_manifest = load_asset_manifest()
+
+@app.url_defaults
+def fingerprinted_static(endpoint, values):
+    if endpoint == "static":
+        hashed = asset_manifest["files"].get(values.get("filename"))
+        if hashed:
+            values["filename"] = "dist/" + hashed
+
+@app.add_template_global
+def asset_built(name: str) -> bool:
+    return name in asset_manifest["files"]
+
+@app.add_template_global
+def srcset(name: str, mime: str) -> str:
+    """"url 640w, url 1024w" for a built image variant, or "" when there is none."""
+    return ", ".join(f"{url_for('static', filename='dist/' + f)} {w}w"
+                     for f, w in asset_manifest["variants"].get(name, {}).get(mime, []))
+
+def serve_static(filename):
+    if not filename.startswith("dist/"):
+        return app.send_static_file(filename)
+    path = safe_join(ASSET_DIST, filename[len("dist/"):])
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    for coding, ext in PRECOMPRESSED:
+        if request.accept_encodings[coding] and os.path.isfile(path + ext):
+            resp = send_file(path + ext, mimetype=mimetype, conditional=True, max_age=STATIC_IMMUTABLE_MAX_AGE)
+            resp.headers["Content-Encoding"] = coding
+            break
+    else:
+        resp = send_file(path, mimetype=mimetype, conditional=True, max_age=STATIC_IMMUTABLE_MAX_AGE)
+    # The name changes whenever the content does
+    resp.cache_control.immutable = True
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+app.view_functions["static"] = serve_static
+
+# ------------ Page cache ------------
+# Public pages depend only on the catalog, the shop's local date and the asset build, so each
+# worker renders them once per (catalog, date, build) and answers If-None-Match with 304.
+PAGE_CACHE_MAX_AGE = int(os.environ.get("PAGE_CACHE_MAX_AGE", "300"))
+_page_cache = {}  # endpoint -> (key, body, etag)
+_page_cache_lock = threading.Lock()
+metrics.describe("carshop_page_cache_renders_total", "counter", "Public pages rendered because the cached copy was missing or stale.")
+
+def cached_page(view):
+    @wraps(view)
+    def wrapper():
+        now_local = datetime.now(SHOP_TZ)
+        key = (get_catalog().fingerprint, now_local.date(), asset_manifest["build"])
+        hit = _page_cache.get(request.endpoint)
+        if hit is None or hit[0] != key:
+            body = view().encode()
+            hit = (key, body, hashlib.sha1(body).hexdigest()[:16])
+            with _page_cache_lock:
+                _page_cache[request.endpoint] = hit
+            metrics.inc("carshop_page_cache_renders_total", endpoint=request.endpoint)
+        resp = make_response(hit[1])
+        resp.set_etag(hit[2])
+        # Never let a shared cache carry a page past local midnight (the date picker starts at today)
+        midnight = SHOP_TZ.localize(datetime.combine(now_local.date() + timedelta(days=1), time(0, 0)))
+        resp.cache_control.public = True
+        resp.cache_control.max_age = max(0, min(PAGE_CACHE_MAX_AGE, int((midnight - now_local).total_seconds())))
+        return resp.make_conditional(request)
+    return wrapper
 
 # ------------ Routes ------------
+# How far ahead customers can look and book
+BOOKING_HORIZON_DAYS = int(os.environ.get("BOOKING_HORIZON_DAYS", "365"))
+
+def bookable_day(d: date) -> bool:
+    # A day of slack behind for clients whose "today" is still yesterday
+    today = datetime.now(SHOP_TZ).date()
+    return today - timedelta(days=1) <= d <= today + timedelta(days=BOOKING_HORIZON_DAYS)
+
 @app.get("/")
+@cached_page
 def index():
-    with SASession(engine) as s:
-        services = list(s.scalars(select(Service).where(Service.is_addon == 0).order_by(Service.name)).all())
-        addons = list(s.scalars(select(Service).where(Service.is_addon == 1).order_by(Service.name)).all())
-
-    services_data = [{
-        "id": sv.id, "name": sv.name, "code": sv.code, "price": sv.price,
-        "resource_type": sv.resource_type, "duration_minutes": sv.duration_minutes,
-        "duration_days": sv.duration_days, "is_addon": bool(sv.is_addon),
-        "description": sv.description or ""
-    } for sv in services]
-    addons_data = [{
-        "id": sv.id, "name": sv.name, "code": sv.code, "price": sv.price,
-        "resource_type": sv.resource_type, "duration_minutes": sv.duration_minutes,
-        "duration_days": sv.duration_days, "is_addon": bool(sv.is_addon),
-        "description": sv.description or ""
-    } for sv in addons]
-
+    cat = get_catalog()
     today_local = datetime.now(SHOP_TZ).date()
     return render_template("index.html",
-        services=services, addons=addons,
-        services_data=services_data, addons_data=addons_data,
-        today=today_local, tz=TZ_NAME)
+        services=cat.services, addons=cat.addons, catalog_version=cat.fingerprint,
+        today=today_local, last_day=today_local + timedelta(days=BOOKING_HORIZON_DAYS), tz=TZ_NAME)
 
 
 @app.get("/api/services")
 def api_services():
-    with SASession(engine) as s:
-        svcs = list(s.scalars(select(Service)).all())
-        return jsonify([{
-            "id": x.id, "name": x.name, "code": x.code, "price": x.price,
-            "resource_type": x.resource_type, "duration_minutes": x.duration_minutes,
-            "duration_days": x.duration_days, "is_addon": bool(x.is_addon), "description": x.description
-        } for x in svcs])
+    cat = get_catalog()
+    resp = make_response(cat.all_json)
+    resp.mimetype = "application/json"
+    resp.set_etag(cat.fingerprint)
+    resp.cache_control.public = True
+    if request.args.get("v") == cat.fingerprint:
+        # The booking page asks for ?v=<fingerprint>, so this URL's content never changes
+        resp.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.max_age = PAGE_CACHE_MAX_AGE
+    return resp.make_conditional(request)
 
 @app.get("/api/availability")
 def api_availability():
@@ -305,25 +1772,72 @@ def api_availability():
     addon_codes = request.args.getlist("addons")
     if not service_code or not day_str:
         return jsonify({"error": "Missing service or day"}), 400
-    day = datetime.strptime(day_str, "%Y-%m-%d").date()
-    with SASession(engine) as s:
-        svc = s.scalar(select(Service).where(Service.code == service_code))
-        if not svc:
-            return jsonify({"error": "Service not found"}), 404
-        addons = []
-        for code in addon_codes:
-            a = s.scalar(select(Service).where(Service.code == code))
-            if a:
-                addons.append(a)
-        slots = available_slots(svc, day, addons)
-        # format times in local
-        result = [{
-            "start": to_utc(st).isoformat(),
-            "end": to_utc(en).isoformat(),
-            "label": st.strftime("%I:%M %p") + " → " + en.strftime("%I:%M %p")
-        } for st, en in slots]
-
-        return jsonify(result)
+    try:
+        day = datetime.strptime(day_str, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "day must be YYYY-MM-DD"}), 400
+    if not bookable_day(day):
+        return jsonify({"error": f"day must be within {BOOKING_HORIZON_DAYS} days from today"}), 400
+    cat = get_catalog()
+    svc = cat.get(service_code)
+    if not svc:
+        return jsonify({"error": "Service not found"}), 404
+    return jsonify(cached_available_slots(svc, day, cat.lookup(addon_codes)))
+
+@app.get("/api/availability/next")
+def api_availability_next():
+    service_code = request.args.get("service")
+    addon_codes = request.args.getlist("addons")
+    if not service_code:
+        return jsonify({"error": "Missing service"}), 400
+    try:
+        count = min(max(int(request.args.get("count", 3)), 1), 20)
+    except ValueError:
+        return jsonify({"error": "count must be a number"}), 400
+    cat = get_catalog()
+    svc = cat.get(service_code)
+    if not svc:
+        return jsonify({"error": "Service not found"}), 404
+    slots = next_available_slots(svc, cat.lookup(addon_codes), count)
+    return jsonify([dict(slot_json(st, en), day=st.date().isoformat()) for st, en in slots])
+
+# Longest span /api/availability/range will compute in one go
+MAX_RANGE_DAYS = 62
+
+@app.get("/api/availability/range")
+def api_availability_range():
+    service_code = request.args.get("service")
+    from_str = request.args.get("from")
+    to_str = request.args.get("to")
+    addon_codes = request.args.getlist("addons")
+    if not service_code or not from_str or not to_str:
+        return jsonify({"error": "Missing service, from or to"}), 400
+    try:
+        first = datetime.strptime(from_str, "%Y-%m-%d").date()
+        last = datetime.strptime(to_str, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+    if last < first or (last - first).days >= MAX_RANGE_DAYS:
+        return jsonify({"error": f"Range must be 1 to {MAX_RANGE_DAYS} days"}), 400
+    if not (bookable_day(first) and bookable_day(last)):
+        return jsonify({"error": f"Dates must be within {BOOKING_HORIZON_DAYS} days from today"}), 400
+    days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    cat = get_catalog()
+    svc = cat.get(service_code)
+    if not svc:
+        return jsonify({"error": "Service not found"}), 404
+    by_day = available_slots_for_days(svc, days, cat.lookup(addon_codes))
+    return jsonify({
+        "service": svc.code,
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "days": [{
+            "day": d.isoformat(),
+            "open": business_window(d) is not None,
+            "count": len(by_day[d]),
+            "slots": [slot_json(st, en) for st, en in by_day[d]]
+        } for d in days]
+    })
 
 @app.post("/book")
 def book():
@@ -339,68 +1853,256 @@ def book():
     if not (name and phone and car and service_code and day_str and slot_start_iso):
         return "Missing fields", 400
 
-    with SASession(engine) as s:
-        svc = s.scalar(select(Service).where(Service.code == service_code))
-        if not svc:
-            return "Service not found", 404
-        addons = []
-        for code in addon_codes:
-            a = s.scalar(select(Service).where(Service.code == code))
-            if a: addons.append(a)
-
-        start_utc = datetime.fromisoformat(slot_start_iso)
-        # recompute end to be safe
-        start_local = to_local(start_utc)
-        total_price, add_minutes, add_days = compute_total_and_duration(svc, addons)
-        end_local = end_time_for_span(start_local, add_minutes, add_days)
-        end_utc = to_utc(end_local)
-
-        # capacity check again
-        if not fits_capacity(svc.resource_type, start_utc, end_utc):
-            return "Selected time no longer available. Please go back and pick another slot.", 409
-
-        appt = Appointment(
-            customer_name=name, phone=phone, car_info=car,
-            primary_service_code=svc.code, addon_codes=json.dumps([a.code for a in addons]),
-            resource_type=svc.resource_type, start_utc=start_utc, end_utc=end_utc,
-            total_price=total_price
-        )
-        s.add(appt)
-        s.commit()
-        # Build absolute .ics link
-        ics_link = request.url_root.rstrip("/") + url_for("ics_appt", appt_id=appt.id)
-        msg = (
-            f"✅ New booking\n"
-            f"Name: {name}\n"
-            f"Phone: {phone}\n"
-            f"Car: {car}\n"
-            f"Service: {svc.name}\n"
-            f"When: {to_local(start_utc).strftime('%Y-%m-%d %I:%M %p')} → "
-            f"{to_local(end_utc).strftime('%I:%M %p')} ({TZ_NAME})\n"
-            f"Price: ${total_price}\n"
-            f"Calendar: {ics_link}"
-        )
-        send_telegram(msg)
-        return redirect(url_for("success", appt_id=appt.id))
+    cat = get_catalog()
+    svc = cat.get(service_code)
+    if not svc:
+        return "Service not found", 404
+    addons = cat.lookup(addon_codes)
+
+    try:
+        start_utc = datetime.fromisoformat(slot_start_iso).astimezone(pytz.utc)
+    except ValueError:
+        return "Invalid slot", 400
+    # recompute end to be safe
+    start_local = to_local(start_utc)
+    if not bookable_day(start_local.date()):
+        return "Invalid slot", 400
+    total_price, add_minutes, add_days = compute_total_and_duration(svc, addons)
+    end_local = end_time_for_span(start_local, add_minutes, add_days)
+    end_utc = to_utc(end_local)
+    taken_msg = "Selected time no longer available. Please go back and pick another slot."
+
+    busy = False
+    for attempt in range(BOOKING_ATTEMPTS):
+        try:
+            with SASession(engine) as s:
+                # capacity check again: re-pack the primary service and add-ons on fresh occupancy
+                occupancy = occupancy_for_visits(svc, addons, [(start_local, end_local)])
+                spans = plan_segments(svc, addons, start_local, end_local, occupancy)
+                if spans is None:
+                    return taken_msg, 409
+
+                appt = Appointment(
+                    customer_name=name, phone=phone, car_info=car,
+                    primary_service_code=svc.code, addon_codes=json.dumps([a.code for a in addons]),
+                    resource_type=svc.resource_type, start_utc=start_utc, end_utc=end_utc,
+                    total_price=total_price
+                )
+                s.add(appt)
+                s.flush()
+                store_segments(s, appt.id, spans)
+                index_appointments(s, [(appt.id, name, phone, car)])
+                # The ledger settles races the read check above cannot see
+                reserve(s, appt.id, spans)
+                record_change(s, appt)
+                # Build absolute .ics link
+                ics_link = request.url_root.rstrip("/") + url_for("ics_appt", appt_id=appt.id)
+                msg = (
+                    f"✅ New booking\n"
+                    f"Name: {name}\n"
+                    f"Phone: {phone}\n"
+                    f"Car: {car}\n"
+                    f"Service: {svc.name}\n"
+                    f"When: {to_local(start_utc).strftime('%Y-%m-%d %I:%M %p')} → "
+                    f"{to_local(end_utc).strftime('%I:%M %p')} ({TZ_NAME})\n"
+                    f"Price: ${total_price}\n"
+                    f"Calendar: {ics_link}"
+                )
+                # Queued in the booking's own transaction; delivery happens off the request path
+                enqueue_telegram(s, msg)
+                s.commit()
+                appt_id = appt.id
+            break
+        except SlotTaken:
+            return taken_msg, 409
+        except IntegrityError as e:
+            if not lost_bay_race(e):
+                raise
+            # Lost a race for a bay: re-read occupancy and try again
+            busy = False
+        except OperationalError as e:
+            if not write_contention(e):
+                raise
+            busy = True
+        sleep(random.uniform(0, 0.02 * (attempt + 1)))
+    else:
+        if busy:
+            # The slot may well be free; we just could not get the write lock in time
+            app.logger.warning("book: database busy after %s attempts (%s %s)", BOOKING_ATTEMPTS, svc.code, start_utc)
+            return "The booking system is busy right now. Please try again in a moment.", 503
+        return taken_msg, 409
+    availability_cache.invalidate_spans(spans)
+    outbox.notify()
+    return redirect(url_for("success", appt_id=appt_id))
 
 @app.get("/success/<int:appt_id>")
 def success(appt_id):
     with SASession(engine) as s:
-        appt = s.get(Appointment, appt_id)
+        appt = get_appointment(s, appt_id)
         if not appt:
             abort(404)
-        svc = s.scalar(select(Service).where(Service.code == appt.primary_service_code))
-        addons = []
+        cat = get_catalog()
+        svc = cat.get(appt.primary_service_code)
         try:
             addon_codes = json.loads(appt.addon_codes)
         except Exception:
             addon_codes = []
-        for code in addon_codes:
-            a = s.scalar(select(Service).where(Service.code == code))
-            if a: addons.append(a)
+        addons = cat.lookup(addon_codes)
 
     return render_template("success.html", appt=appt, svc=svc, addons=addons, tz=TZ_NAME, to_local=to_local)
 
+# ------------ Notification outbox ------------
+OUTBOX_BATCH = int(os.environ.get("OUTBOX_BATCH", "20"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_BACKOFF_SECONDS = float(os.environ.get("OUTBOX_BACKOFF_SECONDS", "2"))
+OUTBOX_LEASE_SECONDS = 60  # a claimed message is retried if its sender dies mid-batch
+OUTBOX_HIGH_WATER = int(os.environ.get("OUTBOX_HIGH_WATER", "100"))
+# "thread": each worker drains the outbox in a background thread; "off": run `flask outbox-drain` instead
+OUTBOX_DISPATCHER = os.environ.get("OUTBOX_DISPATCHER", "thread")
+# Delivered messages are kept this long (for checking what went out), then purged by `flask archive`
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "14"))
+
+OUTBOX_SENDERS = {"telegram": timed("send_telegram")(send_telegram)}
+
+def outbox_configured() -> bool:
+    """Whether any channel can send; without one nothing is ever enqueued."""
+    return bool(TELEGRAM_TOKEN and TELEGRAM_CHAT_ID)
+
+def enqueue_telegram(s: SASession, text: str):
+    if not outbox_configured():
+        return
+    s.add(OutboxMessage(channel="telegram", payload=json.dumps({"text": text})))
+
+class OutboxDispatcher:
+    """Delivers outbox rows over one pooled HTTP session, with exponential retry.
+
+    Rows are claimed with a conditional UPDATE and a lease, so any number of
+    workers (or `flask outbox-drain`) can drain the same table without sending
+    a message twice.
+    """
+
+    def __init__(self):
+        self.http = requests.Session()
+        self.wake = threading.Event()
+        self.stats = {"sent": 0, "retried": 0, "failed": 0, "batches": 0,
+                      "pending": 0, "oldest_pending_seconds": 0.0}
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Threads do not survive fork, so each gunicorn worker starts its own
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.http = requests.Session()
+                self._thread = threading.Thread(target=self.run, name="outbox-dispatcher", daemon=True)
+                self._thread.start()
+
+    def notify(self):
+        self.wake.set()
+
+    def run(self):
+        while True:
+            try:
+                handled = self.drain_once()
+            except Exception:
+                app.logger.exception("outbox: dispatch failed")
+                handled = 0
+            if handled < OUTBOX_BATCH:
+                self.wake.wait(OUTBOX_POLL_SECONDS)
+                self.wake.clear()
+
+    def claim(self, now: datetime) -> list[OutboxMessage]:
+        lease = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        claimed = []
+        with SASession(engine, expire_on_commit=False) as s:
+            due = s.scalars(select(OutboxMessage).where(and_(
+                OutboxMessage.status.in_(["pending", "sending"]),
+                OutboxMessage.next_attempt_at <= now
+            )).order_by(OutboxMessage.next_attempt_at).limit(OUTBOX_BATCH)).all()
+            for msg in due:
+                res = s.execute(update(OutboxMessage).where(and_(
+                    OutboxMessage.id == msg.id,
+                    OutboxMessage.status.in_(["pending", "sending"]),
+                    OutboxMessage.next_attempt_at <= now
+                )).values(status="sending", next_attempt_at=lease)
+                   .execution_options(synchronize_session=False))
+                if res.rowcount == 1:
+                    claimed.append(msg)
+            s.commit()
+        return claimed
+
+    def drain_once(self) -> int:
+        now = datetime.now(pytz.utc)
+        batch = self.claim(now)
+        results = []
+        for msg in batch:
+            try:
+                OUTBOX_SENDERS[msg.channel](json.loads(msg.payload)["text"], http=self.http)
+                results.append((msg, None))
+            except Exception as e:
+                results.append((msg, f"{type(e).__name__}: {e}"))
+        with SASession(engine) as s:
+            for msg, error in results:
+                if error is None:
+                    values = {"status": "sent", "sent_at": datetime.now(pytz.utc), "attempts": msg.attempts + 1}
+                    self.stats["sent"] += 1
+                elif msg.attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    values = {"status": "failed", "attempts": msg.attempts + 1, "last_error": error}
+                    self.stats["failed"] += 1
+                    app.logger.error("outbox: giving up on message %s: %s", msg.id, error)
+                else:
+                    delay = min(OUTBOX_BACKOFF_SECONDS * 2 ** msg.attempts, 3600)
+                    values = {"status": "pending", "attempts": msg.attempts + 1, "last_error": error,
+                              "next_attempt_at": datetime.now(pytz.utc) + timedelta(seconds=delay)}
+                    self.stats["retried"] += 1
+                s.execute(update(OutboxMessage).where(OutboxMessage.id == msg.id).values(**values)
+                          .execution_options(synchronize_session=False))
+            pending, oldest = s.execute(select(func.count(OutboxMessage.id), func.min(OutboxMessage.created_at))
+                                        .where(OutboxMessage.status.in_(["pending", "sending"]))).one()
+            s.commit()
+        self.stats["batches"] += 1 if batch else 0
+        self.stats["pending"] = pending
+        self.stats["oldest_pending_seconds"] = (now - as_utc(oldest)).total_seconds() if oldest else 0.0
+        if pending > OUTBOX_HIGH_WATER:
+            app.logger.warning("outbox: %s messages waiting, oldest %.0fs", pending, self.stats["oldest_pending_seconds"])
+        return len(batch)
+
+outbox = OutboxDispatcher()
+
+def purge_outbox(older_than_days: int = OUTBOX_RETENTION_DAYS, batch: int = ARCHIVE_BATCH) -> int:
+    """Delete messages delivered more than older_than_days ago; failed ones stay for inspection."""
+    cutoff = datetime.now(pytz.utc) - timedelta(days=older_than_days)
+    purged = 0
+    while True:
+        with engine.begin() as conn:
+            ids = select(OutboxMessage.id).where(OutboxMessage.status == "sent",
+                                                 OutboxMessage.sent_at < cutoff).limit(batch).scalar_subquery()
+            n = conn.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids))).rowcount
+        purged += n
+        if n < batch:
+            return purged
+
+@app.before_request
+def start_outbox_dispatcher():
+    # No channel configured (the usual local setup): nothing to deliver, so no polling thread
+    if OUTBOX_DISPATCHER == "thread" and outbox_configured():
+        outbox.start()
+
+@app.cli.command("outbox-drain")
+@click.option("--forever", is_flag=True, help="Keep polling instead of exiting once the outbox is empty.")
+def outbox_drain(forever):
+    """Deliver queued notifications from this process."""
+    if forever:
+        outbox.run()
+    while outbox.drain_once():
+        pass
+    click.echo(json.dumps(outbox.stats))
+
 # ------------ Admin ------------
 def require_admin():
     if session.get("is_admin"):
@@ -424,55 +2126,259 @@ def admin_logout():
     session.pop("is_admin", None)
     return redirect(url_for("admin_login_form"))
 
+ADMIN_DAYS = 14
+ADMIN_PAGE_SIZE = 200
+EVENTS_DEFAULT_LIMIT = 500
+EVENTS_MAX_LIMIT = 2000
+
+def encode_cursor(start_utc: datetime, appt_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{as_utc(start_utc).isoformat()}|{appt_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(token: str):
+    """(start_utc, id) from encode_cursor(); ValueError if it is not one."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        start_iso, appt_id = raw.split("|")
+        return as_utc(datetime.fromisoformat(start_iso)), int(appt_id)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+def after_cursor(token, model=Appointment):
+    """Keyset condition for rows after a cursor, ordered by (start_utc, id)."""
+    if not token:
+        return True
+    return tuple_(model.start_utc, model.id) > tuple_(*decode_cursor(token))
+
+def parse_statuses(raw):
+    """?status=booked,done -> ["booked", "done"]; None when not given."""
+    if not raw:
+        return None
+    statuses = [st.strip() for st in raw.split(",") if st.strip()]
+    unknown = sorted(set(statuses) - set(APPOINTMENT_STATUSES))
+    if unknown:
+        raise ValueError(f"Unknown status: {', '.join(unknown)}")
+    return statuses
+
+def day_stats(first: date, days: int) -> dict:
+    """{(day, resource_type): {"count", "revenue", "utilization"}} for live appointments.
+
+    Counts and revenue come from one grouped query, bucketed by local day with a
+    CASE over the day boundaries (so DST days stay exact on every backend);
+    utilization is booked bay time over open bay time, from the occupancy index.
+    """
+    day_list = [first + timedelta(days=i) for i in range(days)]
+    bounds = [to_utc(datetime.combine(d, time(0, 0))) for d in day_list + [first + timedelta(days=days)]]
+    day_col = case(*[(Appointment.start_utc < bounds[i + 1], i) for i in range(days)]).label("day_index")
+    with SASession(engine) as s:
+        rows = s.execute(select(day_col, Appointment.resource_type, func.count(Appointment.id), func.sum(Appointment.total_price))
+                         .where(Appointment.status != "canceled",
+                                Appointment.start_utc >= bounds[0], Appointment.start_utc < bounds[-1])
+                         .group_by(day_col, Appointment.resource_type)).all()
+    stats = {}
+    for day_index, rt, count, revenue in rows:
+        stats[(day_list[day_index], rt)] = {"count": count, "revenue": revenue or 0, "utilization": 0.0}
+    # Naming the resource types lets the range use ix_segments_window instead of a full scan
+    occupancy = load_occupancy(bounds[0], bounds[-1], list(RESOURCE_CAPACITY))
+    for d in day_list:
+        bw = business_window(d)
+        if bw is None:
+            continue
+        open_utc, close_utc = to_utc(bw[0]), to_utc(bw[1])
+        for rt, cap in RESOURCE_CAPACITY.items():
+            busy = occupancy.get(rt, EMPTY_TIMELINE).busy_seconds(open_utc, close_utc)
+            if busy:
+                entry = stats.setdefault((d, rt), {"count": 0, "revenue": 0, "utilization": 0.0})
+                entry["utilization"] = busy / (cap * (close_utc - open_utc).total_seconds())
+    return stats
+
 @app.get("/admin")
 def admin():
     if not require_admin():
         return redirect(url_for("admin_login_form"))
-    # Show a simple calendar list for the next 14 days
+    # Upcoming appointments for the next ADMIN_DAYS days, a page at a time
     start_local = datetime.now(SHOP_TZ).date()
-    end_local = start_local + timedelta(days=14)
+    end_local = start_local + timedelta(days=ADMIN_DAYS)
+    try:
+        statuses = parse_statuses(request.args.get("status"))
+        keyset = after_cursor(request.args.get("after"))
+    except ValueError as exc:
+        return str(exc), 400
+    conds = [Appointment.start_utc >= to_utc(datetime.combine(start_local, time(0, 0))),
+             Appointment.start_utc < to_utc(datetime.combine(end_local, time(0, 0))),
+             keyset]
+    if statuses:
+        conds.append(Appointment.status.in_(statuses))
     with SASession(engine) as s:
-        appts = list(s.scalars(select(Appointment).where(
-            and_(Appointment.start_utc >= to_utc(datetime.combine(start_local, time(0,0))),
-                 Appointment.start_utc < to_utc(datetime.combine(end_local, time(0,0)))
-            )
-        ).order_by(Appointment.start_utc)).all())
-    # group by day
+        rows = s.execute(select(Appointment.id, Appointment.start_utc, Appointment.end_utc, Appointment.customer_name,
+                                Appointment.car_info, Appointment.phone, Appointment.primary_service_code,
+                                Appointment.status, Appointment.total_price)
+                         .where(and_(*conds)).order_by(Appointment.start_utc, Appointment.id)
+                         .limit(ADMIN_PAGE_SIZE + 1)).all()
+    next_after = encode_cursor(rows[ADMIN_PAGE_SIZE - 1].start_utc, rows[ADMIN_PAGE_SIZE - 1].id) if len(rows) > ADMIN_PAGE_SIZE else None
+    # group by day, converting each timestamp once
     grouped = {}
-    for a in appts:
-        d = to_local(a.start_utc).date().isoformat()
-        grouped.setdefault(d, []).append(a)
-    return render_template("admin.html", grouped=grouped, tz=TZ_NAME, to_local=to_local)
+    for r in rows[:ADMIN_PAGE_SIZE]:
+        st, en = to_local(r.start_utc), to_local(r.end_utc)
+        grouped.setdefault(st.date().isoformat(), []).append({
+            "id": r.id, "time": f"{st:%I:%M %p} → {en:%I:%M %p}", "customer_name": r.customer_name,
+            "car_info": r.car_info, "phone": r.phone, "primary_service_code": r.primary_service_code,
+            "status": r.status, "total_price": r.total_price,
+        })
+    stats = {}
+    for (d, rt), entry in day_stats(start_local, ADMIN_DAYS).items():
+        stats.setdefault(d.isoformat(), {})[rt] = entry
+    return render_template("admin.html", grouped=grouped, stats=stats, tz=TZ_NAME, statuses=APPOINTMENT_STATUSES,
+                           status_filter=request.args.get("status", ""), next_after=next_after, days=ADMIN_DAYS)
+
+@app.post("/admin/appointments/<int:appt_id>/status")
+def admin_set_status(appt_id):
+    if not require_admin():
+        return redirect(url_for("admin_login_form"))
+    status = request.form.get("status", "")
+    if status not in APPOINTMENT_STATUSES:
+        return "Unknown status", 400
+    with SASession(engine) as s:
+        a = s.get(Appointment, appt_id)
+        if not a:
+            if s.get(ArchivedAppointment, appt_id):
+                return "Archived appointments cannot be changed.", 409
+            abort(404)
+        if a.status == "canceled" and status != "canceled":
+            # Its bays may have been rebooked since; a new booking re-checks capacity
+            return "Canceled appointments cannot be reopened. Book a new slot instead.", 409
+        if status != a.status:
+            a.status = status
+            if status == "canceled":
+                release(s, a.id)
+            record_change(s, a)
+            s.commit()
+            if status == "canceled":
+                availability_cache.invalidate_spans(appointment_spans(s, a))
+    return redirect(url_for("admin"))
 
 @app.get("/api/events")
 def api_events():
-    # FullCalendar-style JSON for admin feeds
+    # FullCalendar-style JSON for admin feeds, paged by (start, id): the next page's
+    # cursor comes back in X-Next-Cursor and a Link: rel="next" header
     start_iso = request.args.get("start")
     end_iso = request.args.get("end")
     if not start_iso or not end_iso:
         return jsonify([])
-    start = datetime.fromisoformat(start_iso)
-    end = datetime.fromisoformat(end_iso)
+    try:
+        start = as_utc(datetime.fromisoformat(start_iso))
+        end = as_utc(datetime.fromisoformat(end_iso))
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO 8601 timestamps"}), 400
+    try:
+        limit = min(int(request.args.get("limit", EVENTS_DEFAULT_LIMIT)), EVENTS_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    try:
+        statuses = parse_statuses(request.args.get("status"))
+        keysets = {M: after_cursor(request.args.get("cursor"), M) for M in APPOINTMENT_TABLES}
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    def page(M):
+        conds = [M.start_utc < end, M.end_utc > start, keysets[M]]
+        if statuses:
+            conds.append(M.status.in_(statuses))
+        return (select(M.id, M.customer_name, M.primary_service_code, M.start_utc, M.end_utc, M.status)
+                .where(and_(*conds)).order_by(M.start_utc, M.id).limit(limit + 1))
+
     with SASession(engine) as s:
-        appts = list(s.scalars(select(Appointment).where(
-            and_(Appointment.start_utc < end, Appointment.end_utc > start)
-        )).all())
-    events = []
-    for a in appts:
-        events.append({
-            "id": a.id,
-            "title": f"{a.customer_name} • {a.primary_service_code}",
-            "start": a.start_utc.isoformat(),
-            "end": a.end_utc.isoformat()
-        })
-    return jsonify(events)
+        events_q = all_appointments(page, appointment_tables(s, start))
+        rows = s.execute(select(events_q).order_by(events_q.c.start_utc, events_q.c.id).limit(limit + 1)).all()
+    events = [{
+        "id": r.id,
+        "title": f"{r.customer_name} • {r.primary_service_code}",
+        "start": as_utc(r.start_utc).isoformat(),
+        "end": as_utc(r.end_utc).isoformat(),
+        "status": r.status,
+    } for r in rows[:limit]]
+    resp = jsonify(events)
+    if len(rows) > limit:
+        cursor = encode_cursor(rows[limit - 1].start_utc, rows[limit - 1].id)
+        resp.headers["X-Next-Cursor"] = cursor
+        args = request.args.to_dict()
+        args["cursor"] = cursor
+        resp.headers["Link"] = f'<{url_for("api_events", _external=True, **args)}>; rel="next"'
+    return resp
+
+@app.get("/api/admin/search")
+def api_admin_search():
+    # Ranked matches on customer name, phone or car/plate, a page at a time (?offset=)
+    if not require_admin():
+        return jsonify({"error": "Login required"}), 401
+    terms = search_terms(request.args.get("q", ""))
+    if not terms:
+        return jsonify({"error": "Search needs at least 3 letters or digits"}), 400
+    try:
+        limit = min(int(request.args.get("limit", SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be numbers"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"error": "limit must be positive and offset not negative"}), 400
+    with SASession(engine) as s:
+        hits = search_index.search(s, terms, limit + 1, offset)
+        ids = [h[0] for h in hits[:limit]]
+        found = all_appointments(lambda M: select(M.id, M.customer_name, M.phone, M.car_info,
+                                                  M.primary_service_code, M.start_utc, M.status)
+                                 .where(M.id.in_(ids)))
+        rows = {r.id: r for r in s.execute(select(found))} if ids else {}
+    results = [{
+        "id": r.id, "customer_name": r.customer_name, "phone": r.phone, "car_info": r.car_info,
+        "service": r.primary_service_code, "start": as_utc(r.start_utc).isoformat(), "status": r.status,
+        "ics": url_for("ics_appt", appt_id=r.id),
+    } for r in (rows.get(i) for i in ids) if r is not None]
+    return jsonify({"results": results, "next_offset": offset + limit if len(hits) > limit else None})
 
 # ------------ iCal ------------
+def record_change(s: SASession, a: Appointment):
+    """Log a write to an appointment inside the caller's transaction and stamp it with the log id."""
+    change = AppointmentChange(appointment_id=a.id)
+    s.add(change)
+    s.flush()
+    if a.seq is not None:
+        a.revision = (a.revision or 0) + 1
+    a.seq = change.id
+
+def feed_version():
+    """(newest change id, its time) without touching the appointments table."""
+    with SASession(engine) as s:
+        row = s.execute(select(AppointmentChange.id, AppointmentChange.changed_at)
+                        .order_by(AppointmentChange.id.desc()).limit(1)).first()
+    if row is None:
+        return 0, None
+    return row[0], as_utc(row[1])
+
+def ics_status(a) -> str:
+    return "CANCELLED" if a.status == "canceled" else "CONFIRMED"
+
+def ics_event_lines(a, svc_name: str, dtstamp: str) -> list[str]:
+    start = as_utc(a.start_utc).astimezone(SHOP_TZ)
+    end = as_utc(a.end_utc).astimezone(SHOP_TZ)
+    return [
+        "BEGIN:VEVENT",
+        f"UID:appt-{a.id}@carshop",
+        f"DTSTAMP:{dtstamp}",
+        f"SEQUENCE:{a.revision or 0}",
+        f"STATUS:{ics_status(a)}",
+        f"SUMMARY:Car service - {svc_name}",
+        f"DTSTART;TZID={TZ_NAME}:{start.strftime('%Y%m%dT%H%M%S')}",
+        f"DTEND;TZID={TZ_NAME}:{end.strftime('%Y%m%dT%H%M%S')}",
+        f"DESCRIPTION:Customer: {a.customer_name}\\nPhone: {a.phone}\\nCar: {a.car_info}\\nService: {svc_name}",
+        "END:VEVENT"
+    ]
+
 def ics_for_appt(a: Appointment, svc_name: str):
     dtstamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     uid = f"appt-{a.id}@carshop"
-    start = a.start_utc.astimezone(SHOP_TZ)
-    end = a.end_utc.astimezone(SHOP_TZ)
+    start = as_utc(a.start_utc).astimezone(SHOP_TZ)
+    end = as_utc(a.end_utc).astimezone(SHOP_TZ)
     # VALARM 1 hour before
     ics = f"""BEGIN:VCALENDAR
 VERSION:2.0
@@ -482,6 +2388,8 @@ METHOD:PUBLISH
 BEGIN:VEVENT
 UID:{uid}
 DTSTAMP:{dtstamp}
+SEQUENCE:{a.revision or 0}
+STATUS:{ics_status(a)}
 SUMMARY:Car service - {svc_name}
 DTSTART;TZID={TZ_NAME}:{start.strftime("%Y%m%dT%H%M%S")}
 DTEND;TZID={TZ_NAME}:{end.strftime("%Y%m%dT%H%M%S")}
@@ -499,56 +2407,143 @@ END:VCALENDAR
 @app.get("/ics/<int:appt_id>.ics")
 def ics_appt(appt_id):
     with SASession(engine) as s:
-        a = s.get(Appointment, appt_id)
+        a = get_appointment(s, appt_id)
         if not a:
             abort(404)
-        svc_name = a.primary_service_code
-        svc = s.scalar(select(Service).where(Service.code == a.primary_service_code))
-        if svc:
-            svc_name = svc.name
+        svc = get_catalog().get(a.primary_service_code)
+        svc_name = svc.name if svc else a.primary_service_code
     content = ics_for_appt(a, svc_name)
     resp = make_response(content)
     resp.headers["Content-Type"] = "text/calendar; charset=utf-8"
     resp.headers["Content-Disposition"] = f'attachment; filename="appointment-{appt_id}.ics"'
     return resp
 
+# Rows fetched per round trip while streaming the feed
+FEED_BATCH = 500
+def feed_columns(M):
+    return (M.id, M.customer_name, M.phone, M.car_info, M.primary_service_code,
+            M.start_utc, M.end_utc, M.status, M.revision, M.seq)
+FEED_DELTA_LIMIT = 1000
+# Change-log ids are handed out before commit, so a slow transaction can land below an id a
+# client has already seen; tokens only advance past changes at least this old
+SYNC_SETTLE_SECONDS = 10
+
 @app.get("/feed.ics")
 def ics_feed():
-    # ICS calendar for all appointments
+    # ICS calendar for all appointments, optionally windowed with ?from=YYYY-MM-DD&to=YYYY-MM-DD (local days)
+    try:
+        first = datetime.strptime(request.args["from"], "%Y-%m-%d").date() if request.args.get("from") else None
+        last = datetime.strptime(request.args["to"], "%Y-%m-%d").date() if request.args.get("to") else None
+    except ValueError:
+        return "Dates must be YYYY-MM-DD", 400
+
+    # Conditional GET is answered from the change log alone
+    version, changed_at = feed_version()
+    cat = get_catalog()
+    etag = hashlib.sha1(f"{version}:{first}:{last}:{cat.fingerprint}".encode()).hexdigest()
+    # HTTP dates are whole seconds, so Last-Modified is only sent (and If-Modified-Since only
+    # trusted) once the newest change's second is over: a later change in that same second
+    # would otherwise hide behind a 304
+    last_modified = None
+    if changed_at is not None and changed_at < datetime.now(pytz.utc).replace(microsecond=0):
+        last_modified = changed_at.replace(microsecond=0)
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and last_modified is not None and request.if_modified_since is not None
+            and last_modified <= request.if_modified_since):
+        resp = Response(status=304)
+    else:
+        def window(M):
+            conds = []
+            if first is not None:
+                conds.append(M.end_utc > to_utc(datetime.combine(first, time(0, 0))))
+            if last is not None:
+                conds.append(M.start_utc < to_utc(datetime.combine(last + timedelta(days=1), time(0, 0))))
+            return and_(True, *conds)
+        # DTSTAMP follows the data rather than the clock so identical feeds stay byte-identical
+        dtstamp = (changed_at or datetime(2000, 1, 1, tzinfo=pytz.utc)).strftime("%Y%m%dT%H%M%SZ")
+
+        def generate():
+            yield "\n".join(["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//CarShop Booking//EN", "CALSCALE:GREGORIAN", "METHOD:PUBLISH"]) + "\n"
+            with SASession(engine) as s:
+                # Live rows first: one archived mid-stream then shows up twice rather than not at all
+                since = to_utc(datetime.combine(first, time(0, 0))) if first is not None else None
+                for M in appointment_tables(s, since):
+                    rows = s.execute(
+                        select(*feed_columns(M)).where(window(M)).order_by(M.id)
+                        .execution_options(yield_per=FEED_BATCH))
+                    for a in rows:
+                        svc = cat.get(a.primary_service_code)
+                        yield "\n".join(ics_event_lines(a, svc.name if svc else a.primary_service_code, dtstamp)) + "\n"
+            yield "END:VCALENDAR"
+
+        resp = Response(stream_with_context(generate()))
+        resp.headers["Content-Type"] = "text/calendar; charset=utf-8"
+        resp.headers["Content-Disposition"] = 'attachment; filename="carshop-feed.ics"'
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.get("/feed/changes.ics")
+def ics_changes():
+    # Events created, changed or canceled since ?token= (from a previous X-Sync-Token; none or 0
+    # for a full sync). Clients upsert by UID and SEQUENCE, so repeats are harmless.
+    try:
+        token = int(request.args.get("token") or 0)
+        limit = min(int(request.args.get("limit", FEED_DELTA_LIMIT)), FEED_DELTA_LIMIT)
+    except ValueError:
+        return "token and limit must be numbers", 400
+    if token < 0 or limit < 1:
+        return "token must not be negative and limit must be positive", 400
+    cat = get_catalog()
+    settled_before = datetime.now(pytz.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)
     with SASession(engine) as s:
-        appts = list(s.scalars(select(Appointment)).all())
-    dtstamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    lines = ["BEGIN:VCALENDAR","VERSION:2.0","PRODID:-//CarShop Booking//EN","CALSCALE:GREGORIAN","METHOD:PUBLISH"]
-    for a in appts:
-        svc_name = a.primary_service_code
-        with SASession(engine) as s:
-            svc = s.scalar(select(Service).where(Service.code == a.primary_service_code))
-        if svc:
-            svc_name = svc.name
-        start = a.start_utc.astimezone(SHOP_TZ)
-        end = a.end_utc.astimezone(SHOP_TZ)
-        lines += [
-            "BEGIN:VEVENT",
-            f"UID:appt-{a.id}@carshop",
-            f"DTSTAMP:{dtstamp}",
-            f"SUMMARY:Car service - {svc_name}",
-            f"DTSTART;TZID={TZ_NAME}:{start.strftime('%Y%m%dT%H%M%S')}",
-            f"DTEND;TZID={TZ_NAME}:{end.strftime('%Y%m%dT%H%M%S')}",
-            f"DESCRIPTION:Customer: {a.customer_name}\\nPhone: {a.phone}\\nCar: {a.car_info}\\nService: {svc_name}",
-            "END:VEVENT"
-        ]
+        changed = all_appointments(lambda M: select(*feed_columns(M)).where(M.seq > token)
+                                   .order_by(M.seq).limit(limit + 1))
+        rows = s.execute(select(changed).order_by(changed.c.seq).limit(limit + 1)).all()
+        # Newest log id old enough that nothing below it can still be committing
+        settled = s.scalar(select(AppointmentChange.id).where(AppointmentChange.changed_at <= settled_before)
+                           .order_by(AppointmentChange.id.desc()).limit(1)) or 0
+    more = len(rows) > limit
+    rows = rows[:limit]
+    next_token = max(token, min(settled, rows[-1].seq if more else settled))
+    dtstamp = datetime.now(pytz.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//CarShop Booking//EN", "CALSCALE:GREGORIAN", "METHOD:PUBLISH"]
+    for a in rows:
+        svc = cat.get(a.primary_service_code)
+        lines += ics_event_lines(a, svc.name if svc else a.primary_service_code, dtstamp)
     lines.append("END:VCALENDAR")
-    content = "\n".join(lines)
-    resp = make_response(content)
+    resp = make_response("\n".join(lines))
     resp.headers["Content-Type"] = "text/calendar; charset=utf-8"
-    resp.headers["Content-Disposition"] = 'attachment; filename="carshop-feed.ics"'
+    resp.headers["X-Sync-Token"] = str(next_token)
+    if more:
+        resp.headers["X-Sync-More"] = "1"
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.get("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(403)
+    extra = [
+        ("carshop_outbox_pending", "gauge", "Notifications waiting for delivery.", outbox.stats["pending"]),
+        ("carshop_outbox_oldest_pending_seconds", "gauge", "Age of the oldest undelivered notification.", outbox.stats["oldest_pending_seconds"]),
+        ("carshop_outbox_sent_total", "counter", "Notifications delivered by this worker.", outbox.stats["sent"]),
+        ("carshop_outbox_retried_total", "counter", "Failed deliveries scheduled for retry by this worker.", outbox.stats["retried"]),
+        ("carshop_outbox_failed_total", "counter", "Notifications given up on by this worker.", outbox.stats["failed"]),
+    ]
+    resp = make_response(metrics.render(extra))
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
     return resp
 
 @app.get("/privacy")
+@cached_page
 def privacy():
     return render_template("privacy.html")
 
 @app.get("/terms")
+@cached_page
 def terms():
     return render_template("terms.html")
 
@@ -556,4 +2551,5 @@ def terms():
 # ------------ Run ------------
 if __name__ == "__main__":
     # For local testing
+    init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,362 @@
+"""Benchmark the booking hot paths against a seeded database.
+
+    python bench.py --rows 100000 --threads 8 --out bench-100k.json
+    python bench.py --db postgresql+psycopg://localhost/carshop_bench --rows 1000000
+
+Seeds a dedicated database (never booking.db unless you point --db at it) with
+appointments spread over every RESOURCE_CAPACITY type, then drives each
+scenario through the Flask test client from several threads and prints JSON
+with p50/p95/p99 latency, throughput and SQL statements per request, so runs
+can be diffed over time.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+from datetime import datetime, timedelta, time
+from time import perf_counter
+
+# name -> default request count (the full feed is heavy at 1M rows, so it gets fewer)
+SCENARIOS = {
+    "availability": 300,
+    "availability_range": 50,
+    "book": 200,
+    "feed": 5,
+    "feed_window": 50,
+    "events": 200,
+    "admin": 100,
+    "mixed": 300,
+    "session": 500,
+    "search": 300,
+    "feed_delta": 300,
+}
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", default="sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench.db"))
+    p.add_argument("--rows", type=int, default=1000, help="appointments to seed (e.g. 1000, 100000, 1000000)")
+    p.add_argument("--per-day", type=int, default=40, help="appointments per day of seeded history")
+    p.add_argument("--future-days", type=int, default=60, help="days of upcoming bookings to seed")
+    p.add_argument("--reseed", action="store_true", help="wipe appointments and seed again")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--requests", type=int, help="requests per scenario (default: per-scenario)")
+    p.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ",".join(SCENARIOS))
+    p.add_argument("--cache", default="off", help="AVAILABILITY_CACHE for the run (off, memory or a path)")
+    p.add_argument("--db-profile", default="tuned", choices=["tuned", "default"],
+                   help="DB_PROFILE for the run; compare both to see what the pool/pragma tuning buys")
+    p.add_argument("--session", default="cookie", choices=["cookie", "sql"],
+                   help="SESSION_BACKEND for the run; the session scenario measures its per-request cost")
+    p.add_argument("--archive-after", type=int, metavar="DAYS",
+                   help="archive done/canceled rows older than DAYS before the run; sweep --rows with and "
+                        "without it to see availability latency stay flat as history grows")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--out", help="write the JSON here as well as to stdout")
+    return p.parse_args()
+
+
+def load_app(args):
+    # The app reads its configuration at import time
+    os.environ["DATABASE_URL"] = args.db
+    os.environ["AVAILABILITY_CACHE"] = args.cache
+    os.environ["DB_PROFILE"] = args.db_profile
+    os.environ["SESSION_BACKEND"] = args.session
+    os.environ["OUTBOX_DISPATCHER"] = "off"
+    os.environ["DB_AUTO_MIGRATE"] = "1"
+    os.environ.pop("TELEGRAM_TOKEN", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    app.app.logger.setLevel("ERROR")
+    return app
+
+
+def seed(A, args, rng):
+    from sqlalchemy import delete, func, insert, select, text
+    from sqlalchemy.orm import Session as SASession
+
+    with SASession(A.engine) as s:
+        existing = s.scalar(select(func.count(A.Appointment.id))) + s.scalar(select(func.count(A.ArchivedAppointment.id)))
+        # Some upcoming rows are skipped when their day is full, so a seeded database falls a little short
+        if existing >= args.rows * 0.95 and not args.reseed:
+            return existing, 0.0
+        for model in (A.Reservation, A.AppointmentSegment, A.AppointmentChange, A.OutboxMessage, A.Appointment,
+                      A.ArchivedAppointment):
+            s.execute(delete(model))
+        s.execute(text("DELETE FROM appointment_search"))
+        s.commit()
+
+    cat = A.get_catalog()
+    primaries = list(cat.services)
+    today = datetime.now(A.SHOP_TZ).date()
+    future_rows = min(args.rows, args.future_days * sum(A.RESOURCE_CAPACITY.values()) * 3)
+    history_days = max(1, (args.rows - future_rows) // args.per_day)
+    started = perf_counter()
+    batch = []
+    inserted = 0
+    # Upcoming bookings respect capacity, like real ones would; history does not need to
+    timelines = {rt: A.ResourceTimeline() for rt in A.RESOURCE_CAPACITY}
+
+    def flush():
+        with SASession(A.engine) as s:
+            s.execute(insert(A.Appointment), batch)
+            s.commit()
+        batch.clear()
+
+    for i in range(args.rows):
+        upcoming = i < future_rows
+        svc = primaries[i % len(primaries)]
+        for _ in range(14):
+            day = (today + timedelta(days=1 + rng.randrange(args.future_days)) if upcoming
+                   else today - timedelta(days=7 + rng.randrange(history_days)))  # clear of multi-day spans reaching today
+            starts = A.slot_candidates_for_date(svc, day)
+            if not starts:
+                continue
+            start_local = rng.choice(starts)
+            end_local = A.end_time_for_span(start_local, svc.duration_minutes, svc.duration_days)
+            start_utc, end_utc = A.to_utc(start_local), A.to_utc(end_local)
+            if not upcoming:
+                break
+            timeline = timelines[svc.resource_type]
+            if timeline.peak_concurrency(start_utc, end_utc) < A.RESOURCE_CAPACITY[svc.resource_type]:
+                timeline.add(start_utc, end_utc)
+                break
+        else:
+            continue
+        # Add-ons would need their own bays checked, so only history gets them
+        addons = [a.code for a in cat.addons if not upcoming and rng.random() < 0.2]
+        batch.append({
+            "customer_name": f"Customer {i}", "phone": f"+961 7{rng.randrange(10**7):07d}",
+            "car_info": f"{rng.choice(['Kia Rio', 'BMW 320i', 'Toyota Corolla', 'Nissan Sunny'])} {rng.randrange(10**6):06d}",
+            "primary_service_code": svc.code, "addon_codes": json.dumps(addons),
+            "resource_type": svc.resource_type,
+            "start_utc": start_utc, "end_utc": end_utc,
+            "total_price": svc.price,
+            "status": "booked" if upcoming else rng.choice(["done", "done", "done", "canceled"]),
+            "notes": "",
+        })
+        inserted += 1
+        if len(batch) >= 10000:
+            flush()
+    if batch:
+        flush()
+    seed_history_segments(A)
+    A.backfill_segments()
+    A.backfill_reservations()
+    A.backfill_search()
+    A.backfill_sequences()
+    return inserted, perf_counter() - started
+
+
+def seed_history_segments(A):
+    """Segments for past rows, as book() wrote them at the time; backfill_segments() only covers
+    upcoming ones. They are what load_occupancy scans, so history has to have them to count."""
+    from sqlalchemy import insert, select
+
+    with A.engine.connect() as conn:
+        rows = conn.execute(select(A.Appointment.id, A.Appointment.resource_type, A.Appointment.addon_codes,
+                                   A.Appointment.start_utc, A.Appointment.end_utc)
+                            .where(A.Appointment.end_utc <= datetime.now(A.pytz.utc))
+                            .execution_options(yield_per=10000)).all()
+    for i in range(0, len(rows), 10000):
+        segments = [{"appointment_id": r.id, "resource_type": rt, "start_utc": st, "end_utc": en}
+                    for r in rows[i:i + 10000] for rt, st, en in A.legacy_spans(r)]
+        with A.engine.begin() as conn:
+            conn.execute(insert(A.AppointmentSegment), segments)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def drive(A, make_request, total, threads, login=False):
+    """Run `total` calls of make_request(client, rng) across threads; returns (latencies, statuses, queries, wall)."""
+    latencies, statuses, queries = [], {}, []
+    lock = threading.Lock()
+    per_thread = [total // threads + (1 if i < total % threads else 0) for i in range(threads)]
+
+    def worker(n, seed):
+        rng = random.Random(seed)
+        client = A.app.test_client()
+        if login:
+            client.post("/admin/login", data={"password": A.ADMIN_PASSWORD})
+        mine = []
+        for _ in range(n):
+            started = perf_counter()
+            resp = make_request(client, rng)
+            body = resp.get_data()  # drain streamed responses inside the timing
+            elapsed = perf_counter() - started
+            # The test client serves on this thread, so its stats include queries a streamed body
+            # ran after Server-Timing was sent
+            mine.append((elapsed, resp.status_code, A.current_stats().queries, len(body)))
+        with lock:
+            for elapsed, status, q, _ in mine:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                if q is not None:
+                    queries.append(q)
+
+    pool = [threading.Thread(target=worker, args=(n, i)) for i, n in enumerate(per_thread) if n]
+    started = perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return latencies, statuses, queries, perf_counter() - started
+
+
+def summarize(latencies, statuses, queries, wall):
+    ordered = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        "requests": len(latencies),
+        "status_counts": {str(k): v for k, v in sorted(statuses.items())},
+        "errors": sum(v for k, v in statuses.items() if k >= 500),
+        "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else None,
+        "p50_ms": ms(percentile(ordered, 0.50)),
+        "p95_ms": ms(percentile(ordered, 0.95)),
+        "p99_ms": ms(percentile(ordered, 0.99)),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def overbooked_buckets(A, first_day, days):
+    """Ledger-sized buckets where any resource runs more cars than it has bays."""
+    start = A.to_utc(datetime.combine(first_day, time(0, 0)))
+    end = A.to_utc(datetime.combine(first_day + timedelta(days=days), time(0, 0)))
+    occupancy = A.load_occupancy(start, end)
+    bad = 0
+    for rt, timeline in occupancy.items():
+        cap = A.RESOURCE_CAPACITY.get(rt, 1)
+        for bucket in A.ledger_buckets(start, end):
+            if timeline.peak_concurrency(bucket, bucket + timedelta(minutes=A.LEDGER_BUCKET_MINUTES)) > cap:
+                bad += 1
+    return bad
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    A = load_app(args)
+    rows, seed_seconds = seed(A, args, rng)
+    archived, archive_seconds = None, None
+    if args.archive_after is not None:
+        started = perf_counter()
+        archived = A.archive_appointments(args.archive_after)
+        A.prune_schedule(args.archive_after)
+        archive_seconds = round(perf_counter() - started, 2)
+    with A.engine.connect() as conn:
+        live_rows = conn.scalar(A.select(A.func.count(A.Appointment.id)))
+        live_segments = conn.scalar(A.select(A.func.count(A.AppointmentSegment.id)))
+
+    cat = A.get_catalog()
+    codes = [s.code for s in cat.services]
+    addon_codes = [a.code for a in cat.addons]
+    today = datetime.now(A.SHOP_TZ).date()
+    days = [today + timedelta(days=i) for i in range(1, args.future_days)]
+
+    def addons_query(r):
+        return "".join(f"&addons={c}" for c in addon_codes if r.random() < 0.3)
+
+    def availability(client, r):
+        return client.get(f"/api/availability?service={r.choice(codes)}&day={r.choice(days)}{addons_query(r)}")
+
+    def availability_range(client, r):
+        first = r.choice(days[:-14])
+        return client.get(f"/api/availability/range?service={r.choice(codes)}&from={first}&to={first + timedelta(days=13)}")
+
+    def book(client, r):
+        svc, day = r.choice(codes), r.choice(days)
+        slots = client.get(f"/api/availability?service={svc}&day={day}").get_json() or [{"start": A.to_utc(datetime.combine(day, time(9, 0))).isoformat()}]
+        return client.post("/book", data={
+            "name": "Bench", "phone": "+961 70000000", "car": "Bench car", "service": svc,
+            "day": day.isoformat(), "slot_start_iso": r.choice(slots)["start"],
+        })
+
+    def feed(client, r):
+        return client.get("/feed.ics")
+
+    def feed_window(client, r):
+        first = r.choice(days[:-7])
+        return client.get(f"/feed.ics?from={first}&to={first + timedelta(days=6)}")
+
+    with A.engine.connect() as conn:
+        latest_change = conn.scalar(A.select(A.func.max(A.AppointmentChange.id))) or 0
+
+    def feed_delta(client, r):
+        # A subscriber polling a few changes behind: should cost the same at any history size
+        return client.get(f"/feed/changes.ics?token={max(0, latest_change - r.randrange(50))}")
+
+    def events(client, r):
+        first = A.to_utc(datetime.combine(r.choice(days[:-7]), time(0, 0)))
+        return client.get(f"/api/events?start={first.isoformat()}&end={(first + timedelta(days=7)).isoformat()}".replace("+", "%2B"))
+
+    def admin(client, r):
+        return client.get("/admin")
+
+    def mixed(client, r):
+        # Readers running while bookings commit: where journal mode and busy handling show up
+        return book(client, r) if r.random() < 0.2 else availability(client, r)
+
+    def search(client, r):
+        # Seeded phones are +961 7xxxxxxx and plates six digits: look both up by fragment
+        q = f"7{r.randrange(10**7):07d}"[:r.choice([5, 8])] if r.random() < 0.5 else f"{r.randrange(10**6):06d}"
+        return client.get(f"/api/admin/search?q={q}")
+
+    def session(client, r):
+        # A logged-in admin on the cheapest route: what remains is mostly opening/saving the session
+        return client.get("/api/services")
+
+    handlers = {"availability": availability, "availability_range": availability_range, "book": book,
+                "feed": feed, "feed_window": feed_window, "feed_delta": feed_delta, "events": events, "admin": admin, "mixed": mixed,
+                "session": session, "search": search}
+    results = {}
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        if name not in handlers:
+            sys.exit(f"unknown scenario {name!r}; choose from {', '.join(handlers)}")
+        total = args.requests or SCENARIOS[name]
+        results[name] = summarize(*drive(A, handlers[name], total, args.threads, login=(name in ("admin", "session", "search"))))
+        if name in ("book", "mixed"):
+            results[name]["overbooked_buckets"] = overbooked_buckets(A, days[0], len(days))
+
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        rev = None
+    report = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "git_rev": rev,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "db": A.engine.url.render_as_string(hide_password=True),
+            "rows": rows,
+            "seed_seconds": round(seed_seconds, 2),
+            "live_rows": live_rows,
+            "live_segments": live_segments,
+            "archived": archived,
+            "archive_seconds": archive_seconds,
+            "threads": args.threads,
+            "availability_cache": args.cache,
+            "db_profile": args.db_profile,
+            "session_backend": args.session,
+        },
+        "results": results,
+    }
+    out = json.dumps(report, indent=2)
+    print(out)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(out + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Build optimized, fingerprinted static assets into static/dist.
+
+    pip install Pillow brotli   # optional: image re-encoding/variants and .br files
+    python build_assets.py
+
+Re-encodes the photos, minifies Logo.svg, writes AVIF/WebP width variants for
+the images listed in RESPONSIVE, compiles the Tailwind classes the templates
+use into one stylesheet, and copies everything to content-hashed names with
+.gz/.br siblings. static/dist/manifest.json maps the original names to the
+hashed ones; the app rewrites url_for('static', ...) through it and serves
+those files with immutable cache headers. Without a manifest the app serves
+static/ as before and falls back to the Tailwind CDN.
+
+Old hashed files are kept so pages rendered by a previous build still load
+during a rolling deploy; pass --clean to start from an empty static/dist.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC = os.path.join(ROOT, "static")
+DIST = os.path.join(STATIC, "dist")
+
+# source image -> widths of the responsive variants (capped at the source width)
+RESPONSIVE = {
+    "hero.jpg": (640, 1024, 1600, 2400),
+    "Logo.png": (64, 128, 192),  # shown 32px high in the header and footer
+}
+# (mime type, extension, Pillow save options), best first: the order <source> tags are emitted in
+VARIANT_FORMATS = (
+    ("image/avif", "avif", {"quality": 50}),
+    ("image/webp", "webp", {"quality": 78, "method": 6}),
+)
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".ico", ".txt"}
+TAILWIND_CMD = os.environ.get("TAILWIND_CMD", "npx --yes tailwindcss@3")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--clean", action="store_true", help="empty static/dist first")
+    p.add_argument("--skip-css", action="store_true", help="do not run Tailwind (pages keep using the CDN)")
+    return p.parse_args()
+
+
+def load_pillow():
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Pillow not installed: images are copied as-is and no variants are built", file=sys.stderr)
+        return None
+    try:
+        import pillow_avif  # noqa: F401  AVIF support for Pillow < 11.2
+    except ImportError:
+        pass
+    Image.init()
+    return Image
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    """Write data to static/dist under a content-hashed name and return that name."""
+    stem, ext = os.path.splitext(name)
+    hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+    path = os.path.join(DIST, hashed)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    if ext.lower() in COMPRESSIBLE:
+        precompress(path, data)
+    return hashed
+
+
+def precompress(path: str, data: bytes):
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        with open(path + ".gz", "wb") as f:
+            f.write(gz)
+    try:
+        import brotli
+    except ImportError:
+        return
+    br = brotli.compress(data, quality=11)
+    if len(br) < len(data):
+        with open(path + ".br", "wb") as f:
+            f.write(br)
+
+
+def _round_number(m):
+    s = f"{float(m.group(0)):.1f}".rstrip("0").rstrip(".")
+    return "0" if s in ("", "-0") else s
+
+
+def minify_svg(text: str) -> bytes:
+    """Trim a traced SVG: 1-decimal coordinates (sub-pixel at any size it is shown), no comments, no whitespace between tags."""
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.S)
+    text = re.sub(r"-?\d+\.\d+", _round_number, text)
+    text = re.sub(r">\s+<", "><", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip().encode()
+
+
+def optimize_image(Image, name: str, data: bytes) -> bytes:
+    if Image is None:
+        return data
+    img = Image.open(io.BytesIO(data))
+    out = io.BytesIO()
+    if img.format == "JPEG":
+        img.convert("RGB").save(out, "JPEG", quality=82, optimize=True, progressive=True)
+    elif img.format == "PNG":
+        img.save(out, "PNG", optimize=True)
+    else:
+        return data
+    # Never ship a "smaller" file that grew
+    return out.getvalue() if out.tell() < len(data) else data
+
+
+def build_variants(Image, name: str, data: bytes, widths) -> dict:
+    """{mime: [[hashed file, width], ...]} for every format this Pillow can write."""
+    variants = {}
+    if Image is None:
+        return variants
+    src = Image.open(io.BytesIO(data))
+    src.load()
+    stem = os.path.splitext(name)[0]
+    for mime, ext, opts in VARIANT_FORMATS:
+        if ext.upper() not in Image.SAVE:
+            print(f"{ext} not supported by this Pillow build, skipping", file=sys.stderr)
+            continue
+        entries = []
+        for width in sorted({min(w, src.width) for w in widths}):
+            img = src if width == src.width else src.resize((width, round(src.height * width / src.width)), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, ext.upper(), **opts)
+            entries.append([fingerprint(f"{stem}-{width}.{ext}", out.getvalue()), width])
+        variants[mime] = entries
+    return variants
+
+
+def build_css() -> bytes:
+    """Compile only the Tailwind classes used in templates/ (see tailwind.config.js)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "app.css")
+        cmd = shlex.split(TAILWIND_CMD) + ["-c", "tailwind.config.js", "-i", os.path.join("assets", "tailwind.css"),
+                                          "-o", out, "--minify"]
+        subprocess.run(cmd, cwd=ROOT, check=True)
+        with open(out, "rb") as f:
+            return f.read()
+
+
+def main():
+    args = parse_args()
+    if args.clean:
+        shutil.rmtree(DIST, ignore_errors=True)
+    os.makedirs(DIST, exist_ok=True)
+    Image = load_pillow()
+    manifest = {"files": {}, "variants": {}}
+
+    for name in sorted(os.listdir(STATIC)):
+        path = os.path.join(STATIC, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(name)[1].lower()
+        if ext == ".svg":
+            built = minify_svg(data.decode())
+        elif ext in (".jpg", ".jpeg", ".png"):
+            built = optimize_image(Image, name, data)
+        else:
+            built = data
+        manifest["files"][name] = fingerprint(name, built)
+        if name in RESPONSIVE:
+            manifest["variants"][name] = build_variants(Image, name, data, RESPONSIVE[name])
+        print(f"{name}: {len(data):,} -> {len(built):,} bytes", file=sys.stderr)
+
+    if not args.skip_css:
+        try:
+            css = build_css()
+        except (OSError, subprocess.CalledProcessError) as exc:
+            print(f"Tailwind build failed ({exc}); pages keep using the CDN", file=sys.stderr)
+        else:
+            manifest["files"]["app.css"] = fingerprint("app.css", css)
+            print(f"app.css: {len(css):,} bytes", file=sys.stderr)
+
+    manifest["build"] = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+    with open(os.path.join(DIST, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(json.dumps(manifest, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, time, timedelta
+
+import pytest
+
+# app.py reads its configuration at import time, so point it at a scratch database first
+_tmp = tempfile.mkdtemp(prefix="carshop-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_tmp, "test.db")
+os.environ["AVAILABILITY_CACHE"] = "off"
+os.environ["OUTBOX_DISPATCHER"] = "off"
+os.environ.pop("DB_AUTO_MIGRATE", None)
+os.environ.pop("TELEGRAM_TOKEN", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as carshop  # noqa: E402
+
+
+def pytest_sessionfinish(session, exitstatus):
+    carshop.engine.dispose()
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def A():
+    carshop.init_db()
+    return carshop
+
+
+@pytest.fixture(autouse=True)
+def empty_schedule(A):
+    with A.engine.begin() as conn:
+        for model in (A.Reservation, A.AppointmentSegment, A.AppointmentChange, A.OutboxMessage,
+                      A.Appointment, A.ArchivedAppointment):
+            conn.execute(A.delete(model))
+        conn.execute(A.text("DELETE FROM appointment_search"))
+    yield
+
+
+@pytest.fixture
+def client(A):
+    return A.app.test_client()
+
+
+@pytest.fixture
+def monday(A):
+    """A Monday a few weeks out, open 9:00-19:00."""
+    day = datetime.now(A.SHOP_TZ).date() + timedelta(days=21)
+    return day + timedelta(days=-day.weekday() % 7)
+
+
+def at(A, day, hour, minute=0):
+    return A.SHOP_TZ.localize(datetime.combine(day, time(hour, minute)))
+
+
+def book(client, service, start_local, addons=()):
+    return client.post("/book", data={
+        "name": "Test", "phone": "+961 70 000 000", "car": "Test car", "service": service,
+        "addons": list(addons), "day": start_local.date().isoformat(),
+        "slot_start_iso": start_local.isoformat(),
+    })
@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+from conftest import at, book
+
+
+def move_to_past(A, days):
+    """Shift every appointment, segment and reservation `days` into the past."""
+    shift = timedelta(days=days)
+    with A.engine.begin() as conn:
+        for model, cols in ((A.Appointment, ("start_utc", "end_utc")),
+                            (A.AppointmentSegment, ("start_utc", "end_utc")),
+                            (A.Reservation, ("bucket",))):
+            for row in conn.execute(A.select(model.id, *(getattr(model, c) for c in cols))).all():
+                conn.execute(A.update(model).where(model.id == row[0]).values(
+                    {c: A.as_utc(v) - shift for c, v in zip(cols, row[1:])}))
+
+
+def count(A, model):
+    with A.engine.connect() as conn:
+        return conn.scalar(A.select(A.func.count(model.id)))
+
+
+def test_finished_appointments_move_to_the_archive(A, client, monday):
+    for hour in (9, 11, 13):
+        assert book(client, "quick_wash", at(A, monday, hour)).status_code == 302
+    client.post("/admin/login", data={"password": A.ADMIN_PASSWORD})
+    client.post("/admin/appointments/1/status", data={"status": "done"})
+    client.post("/admin/appointments/2/status", data={"status": "canceled"})
+    client.post("/admin/appointments/3/status", data={"status": "done"})
+    move_to_past(A, 200)
+
+    # The newest row stays live so SQLite cannot hand its id out again
+    assert A.archive_appointments(90) == 2
+    assert count(A, A.Appointment) == 1 and count(A, A.ArchivedAppointment) == 2
+    with A.engine.connect() as conn:
+        assert set(conn.scalars(A.select(A.AppointmentSegment.appointment_id))) == {3}
+        assert set(conn.scalars(A.select(A.Reservation.appointment_id))) == {3}
+    for appt_id in (1, 2):
+        assert client.get(f"/ics/{appt_id}.ics").status_code == 200
+        assert client.get(f"/success/{appt_id}").status_code == 200
+    assert client.post("/admin/appointments/1/status", data={"status": "booked"}).status_code == 409
+
+    first = A.to_utc(at(A, monday, 0)) - timedelta(days=200)
+    resp = client.get("/api/events", query_string={"start": first.isoformat(), "end": (first + timedelta(days=1)).isoformat()})
+    assert [e["id"] for e in resp.get_json()] == [1, 2, 3]
+    assert client.get("/feed.ics").get_data(as_text=True).count("BEGIN:VEVENT") == 3
+
+
+def test_prune_drops_past_schedule_rows_whatever_the_status(A, client, monday):
+    assert book(client, "quick_wash", at(A, monday, 9)).status_code == 302  # stays "booked"
+    assert book(client, "quick_wash", at(A, monday, 11)).status_code == 302
+    move_to_past(A, 200)
+    assert book(client, "quick_wash", at(A, monday, 9)).status_code == 302  # upcoming
+    assert A.archive_appointments(90) == 0
+    A.prune_schedule(90)
+    assert count(A, A.Appointment) == 3
+    with A.engine.connect() as conn:
+        assert set(conn.scalars(A.select(A.AppointmentSegment.appointment_id))) == {3}
+        assert set(conn.scalars(A.select(A.Reservation.appointment_id))) == {3}
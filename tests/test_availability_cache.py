@@ -0,0 +1,44 @@
+from datetime import date
+
+import pytest
+
+DAY = date(2030, 1, 7)
+DEPS = [("wash", DAY.isoformat())]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(A, request, tmp_path):
+    if request.param == "memory":
+        store = A.MemoryCacheStore(ttl=300, max_entries=100)
+    else:
+        store = A.SQLiteCacheStore(str(tmp_path / "cache.sqlite"), ttl=300, max_entries=100)
+    return A.AvailabilityCache(store)
+
+
+def test_result_is_cached(cache):
+    calls = []
+    compute = lambda: calls.append(1) or ["slot"]
+    assert cache.get_or_compute("k", compute, lambda: DEPS) == ["slot"]
+    assert cache.get_or_compute("k", compute, lambda: DEPS) == ["slot"]
+    assert len(calls) == 1
+
+
+def test_invalidation_during_compute_is_not_overwritten(cache):
+    def compute():
+        # A booking commits and invalidates the day while this (older) snapshot is being computed
+        cache.store.invalidate("wash", [DAY])
+        return ["stale"]
+
+    assert cache.get_or_compute("k", compute, lambda: DEPS) == ["stale"]
+    assert cache.store.get("k") is None
+    assert cache.get_or_compute("k", lambda: ["fresh"], lambda: DEPS) == ["fresh"]
+    assert cache.store.get("k") is not None
+
+
+def test_invalidating_another_resource_keeps_the_result(cache):
+    def compute():
+        cache.store.invalidate("polish", [DAY])
+        return ["slot"]
+
+    cache.get_or_compute("k", compute, lambda: DEPS)
+    assert cache.store.get("k") is not None
@@ -0,0 +1,65 @@
+import random
+import sqlite3
+import threading
+from datetime import timedelta
+
+from sqlalchemy.exc import OperationalError
+
+from conftest import at, book
+
+THREADS = 12
+BOOKINGS_PER_THREAD = 30
+
+
+def test_ledger_prevents_overbooking_under_concurrency(A, monday, monkeypatch):
+    # Blind the read-side capacity check so every request reaches the ledger: only the
+    # reservations' unique constraint can keep a third car out of the two wash bays
+    monkeypatch.setattr(A, "occupancy_for_visits", lambda *args, **kwargs: {})
+    starts = [at(A, monday, 9) + timedelta(minutes=30 * i) for i in range(4)]
+    statuses = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(THREADS)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = A.app.test_client()
+        barrier.wait()
+        mine = [book(client, rng.choice(["quick_wash", "signature_wash"]), rng.choice(starts)).status_code
+                for _ in range(BOOKINGS_PER_THREAD)]
+        with lock:
+            statuses.extend(mine)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(THREADS)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    assert len(statuses) == THREADS * BOOKINGS_PER_THREAD
+    assert set(statuses) <= {302, 409, 503}
+    booked = statuses.count(302)
+    assert booked >= A.RESOURCE_CAPACITY["wash"]
+
+    first, last = A.to_utc(at(A, monday, 0)), A.to_utc(at(A, monday, 23))
+    timeline = A.load_occupancy(first, last)["wash"]
+    assert len(timeline.starts) == booked
+    step = timedelta(minutes=A.LEDGER_BUCKET_MINUTES)
+    peaks = [timeline.peak_concurrency(b, b + step) for b in A.ledger_buckets(first, last)]
+    assert max(peaks) <= A.RESOURCE_CAPACITY["wash"]
+    assert max(peaks) == A.RESOURCE_CAPACITY["wash"]
+
+
+def raise_operational(message):
+    def fail(*args, **kwargs):
+        raise OperationalError("INSERT INTO appointment_segments ...", {}, sqlite3.OperationalError(message))
+    return fail
+
+
+def test_schema_errors_are_not_reported_as_a_taken_slot(A, client, monday, monkeypatch):
+    monkeypatch.setattr(A, "store_segments", raise_operational("no such table: appointment_segments"))
+    assert book(client, "quick_wash", at(A, monday, 9)).status_code == 500
+
+
+def test_exhausted_write_lock_is_a_503_not_a_409(A, client, monday, monkeypatch):
+    monkeypatch.setattr(A, "store_segments", raise_operational("database is locked"))
+    assert book(client, "quick_wash", at(A, monday, 9)).status_code == 503
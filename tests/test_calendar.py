@@ -0,0 +1,25 @@
+from datetime import date, datetime, time, timedelta
+
+
+def test_far_off_days_are_rejected(A, client):
+    assert client.get("/api/availability?service=quick_wash&day=2400-01-03").status_code == 400
+    assert client.get("/api/availability?service=quick_wash&day=9999-12-31").status_code == 400
+    assert client.get("/api/availability/range?service=quick_wash&from=2400-01-03&to=2400-01-09").status_code == 400
+    start = A.SHOP_TZ.localize(datetime(2400, 1, 3, 9))
+    resp = client.post("/book", data={"name": "T", "phone": "1", "car": "c", "service": "quick_wash",
+                                      "day": "2400-01-03", "slot_start_iso": start.isoformat()})
+    assert resp.status_code == 400
+
+
+def test_tables_stay_bounded_for_distant_dates(A):
+    cal = A.BusinessCalendar(A.BUSINESS_HOURS)
+    near = A.SHOP_TZ.localize(datetime.combine(date.today() + timedelta(days=3), time(10)))
+    far = A.SHOP_TZ.localize(datetime(2400, 1, 3, 10))
+    cal.end_time(near, 600, 0)
+    cal.end_time(far, 600, 0)
+    base, minutes, _ = cal._tables
+    assert len(minutes) <= cal.MAX_TABLE_DAYS + 2 * cal.CHUNK_DAYS
+    # Same answers as a calendar that only ever saw the one date
+    for start in (near, far):
+        assert cal.end_time(start, 600, 0) == A.BusinessCalendar(A.BUSINESS_HOURS).end_time(start, 600, 0)
+        assert cal.end_time(start, 0, 4) == A.BusinessCalendar(A.BUSINESS_HOURS).end_time(start, 0, 4)
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from conftest import at, book
+
+
+def slot_starts(client, service, day):
+    resp = client.get(f"/api/availability?service={service}&day={day}")
+    assert resp.status_code == 200
+    return {datetime.fromisoformat(s["start"]) for s in resp.get_json()}
+
+
+def test_back_to_back_intervals_need_one_bay(A):
+    t0 = datetime(2030, 1, 7, 9, tzinfo=pytz.utc)
+    hour = timedelta(hours=1)
+    timeline = A.ResourceTimeline([(t0, t0 + hour), (t0 + hour, t0 + 2 * hour)])
+    assert timeline.peak_concurrency(t0, t0 + 2 * hour) == 1
+    timeline.add(t0 + hour / 2, t0 + 3 * hour / 2)
+    assert timeline.peak_concurrency(t0, t0 + 2 * hour) == 2
+
+
+def test_back_to_back_washes_free_a_bay(A, client, monday):
+    # Two one-hour washes at 9:00 take both bays; at 10:00 both bays are free again
+    assert book(client, "quick_wash", at(A, monday, 9)).status_code == 302
+    assert book(client, "quick_wash", at(A, monday, 9)).status_code == 302
+    starts = slot_starts(client, "quick_wash", monday)
+    assert A.to_utc(at(A, monday, 9, 30)) not in starts
+    assert A.to_utc(at(A, monday, 10)) in starts
+    assert book(client, "quick_wash", at(A, monday, 10)).status_code == 302
+    assert book(client, "quick_wash", at(A, monday, 10)).status_code == 302
+    # 9:00-10:00 and 10:00-11:00 four times over, but never more than two cars at once
+    assert A.fits_capacity("wash", A.to_utc(at(A, monday, 9)), A.to_utc(at(A, monday, 11))) is False
+
+
+def test_third_overlapping_wash_is_rejected(A, client, monday):
+    assert book(client, "signature_wash", at(A, monday, 9)).status_code == 302  # 9:00-11:00
+    assert book(client, "quick_wash", at(A, monday, 9, 30)).status_code == 302  # 9:30-10:30
+    resp = book(client, "quick_wash", at(A, monday, 10))
+    assert resp.status_code == 409
+    assert A.to_utc(at(A, monday, 10)) not in slot_starts(client, "quick_wash", monday)
+    # Once the 9:30 wash leaves, the second bay is free even though the 9:00 one runs on
+    assert book(client, "quick_wash", at(A, monday, 10, 30)).status_code == 302
+    with A.engine.connect() as conn:
+        booked = conn.scalar(A.select(A.func.count(A.Appointment.id)))
+    assert booked == 3
+
+
+def test_occupancy_sees_multi_day_visits_started_before_the_window(A, client, monday):
+    assert book(client, "full_polish", at(A, monday, 9)).status_code == 302  # four business days
+    window = A.to_utc(at(A, monday + timedelta(days=2), 12))
+    timeline = A.load_occupancy(window, window + timedelta(hours=1), ["polish"])["polish"]
+    assert timeline.peak_concurrency(window, window + timedelta(hours=1)) == 1
+    assert book(client, "full_polish", at(A, monday + timedelta(days=2), 9)).status_code == 409
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from werkzeug.http import http_date
+
+from conftest import at, book
+
+
+def test_feed_not_modified_by_etag(A, client, monday):
+    book(client, "quick_wash", at(A, monday, 9))
+    first = client.get("/feed.ics")
+    assert first.status_code == 200
+    again = client.get("/feed.ics", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    book(client, "quick_wash", at(A, monday, 11))
+    assert client.get("/feed.ics", headers={"If-None-Match": first.headers["ETag"]}).status_code == 200
+
+
+def test_if_modified_since_sees_changes_in_the_same_second(A, client, monday):
+    book(client, "quick_wash", at(A, monday, 9))
+    # The newest change's second is not over yet (stamped a little ahead so the test cannot race
+    # the clock); a client holding that same second must still get the new body
+    changed_at = datetime.now(pytz.utc).replace(microsecond=500000) + timedelta(seconds=2)
+    with A.engine.begin() as conn:
+        conn.execute(A.update(A.AppointmentChange).values(changed_at=changed_at))
+    resp = client.get("/feed.ics")
+    assert "Last-Modified" not in resp.headers
+    assert client.get("/feed.ics", headers={"If-Modified-Since": http_date(changed_at)}).status_code == 200
+
+
+def test_if_modified_since_after_the_second_is_over(A, client, monday):
+    book(client, "quick_wash", at(A, monday, 9))
+    with A.engine.begin() as conn:
+        conn.execute(A.update(A.AppointmentChange).values(
+            changed_at=datetime.now(pytz.utc) - timedelta(minutes=5)))
+    resp = client.get("/feed.ics")
+    last_modified = resp.headers["Last-Modified"]
+    assert client.get("/feed.ics", headers={"If-Modified-Since": last_modified}).status_code == 304
+    book(client, "quick_wash", at(A, monday, 11))
+    with A.engine.begin() as conn:
+        conn.execute(A.update(A.AppointmentChange).where(A.AppointmentChange.id == A.select(
+            A.func.max(A.AppointmentChange.id)).scalar_subquery()).values(
+            changed_at=datetime.now(pytz.utc) - timedelta(minutes=1)))
+    assert client.get("/feed.ics", headers={"If-Modified-Since": last_modified}).status_code == 200
+
+
+def test_streamed_feed_queries_reach_metrics_and_budget(A, client, monday):
+    book(client, "quick_wash", at(A, monday, 9))
+    key = ("carshop_http_request_queries_total", (("route", "/feed.ics"),))
+    before = A.metrics._counters.get(key, 0)
+    resp = client.get("/feed.ics")
+    assert "BEGIN:VEVENT" in resp.get_data(as_text=True)
+    resp.close()
+    # feed_version() runs before the headers; the appointment queries run while streaming
+    assert A.metrics._counters[key] - before >= 3
+    A.app.config["QUERY_BUDGET"] = 1
+    try:
+        resp = client.get("/feed.ics")
+        resp.get_data()
+        with pytest.raises(A.QueryBudgetExceeded):
+            resp.close()
+    finally:
+        A.app.config["QUERY_BUDGET"] = None
@@ -0,0 +1,21 @@
+import threading
+
+
+def test_migration_lock_serializes_init_db_runs(A):
+    order = []
+
+    def second():
+        with A.migration_lock():
+            order.append("second")
+
+    with A.migration_lock():
+        t = threading.Thread(target=second)
+        t.start()
+        t.join(0.3)
+        order.append("first")
+    t.join()
+    assert order == ["first", "second"]
+
+
+def test_init_db_is_idempotent(A):
+    assert A.init_db() == []
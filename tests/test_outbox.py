@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+
+def test_dispatcher_stays_off_without_a_channel(A, client, monkeypatch):
+    monkeypatch.setattr(A, "OUTBOX_DISPATCHER", "thread")
+    assert not A.outbox_configured()
+    client.get("/")
+    assert A.outbox._thread is None
+
+
+def test_purge_drops_only_old_sent_messages(A):
+    now = datetime.now(pytz.utc)
+    old, recent = now - timedelta(days=A.OUTBOX_RETENTION_DAYS + 1), now - timedelta(days=1)
+    rows = [("sent", old), ("sent", old), ("sent", recent), ("failed", old), ("pending", None)]
+    with A.engine.begin() as conn:
+        conn.execute(A.insert(A.OutboxMessage), [
+            {"channel": "telegram", "payload": "{}", "status": status, "created_at": sent_at or now,
+             "sent_at": sent_at} for status, sent_at in rows])
+
+    assert A.purge_outbox(batch=1) == 2
+    with A.engine.connect() as conn:
+        left = conn.execute(A.select(A.OutboxMessage.status, A.OutboxMessage.sent_at)).all()
+    assert sorted(status for status, _ in left) == ["failed", "pending", "sent"]
+    assert all(status != "sent" or A.as_utc(sent_at) > old for status, sent_at in left)